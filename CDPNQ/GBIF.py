@@ -1,16 +1,57 @@
 # Ce script télécharge le fichier Excel des données d'espèces suivies part le CDPNQ, extrait les noms scientifiques,
 # interroge l'API GBIF pour obtenir les occurrences géolocalisées au Québec, et enregistre les résultats
-# dans des fichiers Excel et GeoPackage pour une analyse géospatiale ultérieure.
+# dans des fichiers GeoPackage, GeoParquet, FlatGeobuf et/ou Excel (--formats) pour une analyse
+# géospatiale ultérieure.
+#
+# Chaque nom scientifique unique est résolu une seule fois en clé de taxon GBIF (correspondance exacte),
+# puis les occurrences sont recherchées par clé de taxon.
+#
+# Les requêtes GBIF sont envoyées en parallèle (--concurrence) sur une session partagée, avec un débit
+# limité (--requetes-par-seconde) et des reprises automatiques des erreurs 429 et 5xx. Toutes les pages
+# de résultats sont parcourues; au-delà de la limite de pagination de GBIF, le téléchargement asynchrone
+# est utilisé si les variables GBIF_USER, GBIF_PWD et GBIF_EMAIL sont définies.
+#
+# Les réponses sont conservées dans un cache SQLite (--cache) : une exécution répétée ou interrompue
+# est servie surtout depuis le cache, et --hors-ligne permet de rejouer les réponses enregistrées.
+#
+# Les occurrences sont écrites par lots (--taille-lot) dans un répertoire de reprise (--reprise) et les
+# espèces terminées y sont inscrites : une exécution relancée après un arrêt saute ces espèces.
+#
+# --geometrie remplace l'emprise rectangulaire du Québec par un filtre spatial : un WKT, un fichier texte
+# contenant un WKT, ou une couche vectorielle dont le contour simplifié est calculé avec bounding_box.py.
+#
+# --journal écrit la durée et les compteurs de chaque étape (requêtes, réponses du cache, reprises,
+# octets reçus, occurrences, entités écrites) dans un journal JSON; --profil et --memoire ajoutent un
+# profil cProfile et le pic de mémoire de chaque étape (instrumentation.py).
 
+import argparse
+import csv
+import hashlib
+import json
 import os
+import sys
+from array import array
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
 import requests
-import time
 import geopandas as gpd
-from shapely.geometry import Point
-import re
+import shapely
+import zipfile
 from tqdm import tqdm
 
+# bounding_box.py et instrumentation.py se trouvent dans le répertoire parent
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instrumentation
+from bounding_box import default_max_vertices, default_tolerance, read_geometry
+from checkpoint import HarvestCheckpoint
+from gbif_client import GBIFClient
+from http_cache import ResponseCache
+from instrumentation import count, event, stage
+
 # Définir les limites géographiques pour le Québec
 min_latitude = 45.0
 max_latitude = 62.0
@@ -20,91 +61,384 @@ max_longitude = -57.0
 
 # URL du fichier Excel
 excel_url = 'https://cdn-contenu.quebec.ca/cdn-contenu/faune/documents/precaire/LI-especes-suivies_CDPNQ.xlsx'
-
-# Télécharger le fichier Excel
-response = requests.get(excel_url)
-with open('LI-especes-suivies_CDPNQ.xlsx', 'wb') as file:
-    file.write(response.content)
-
-# Lire le fichier Excel et traiter les deux feuilles
 excel_file = 'LI-especes-suivies_CDPNQ.xlsx'
-sheets = pd.read_excel(excel_file, sheet_name=None)
-
-# Créer une liste pour stocker les résultats
-results = []
 
 # URL de base de l'API GBIF
 gbif_api_url = "https://api.gbif.org/v1/occurrence/search"
+species_match_url = "https://api.gbif.org/v1/species/match"
 
-try:
-    for sheet_name, sheet_df in sheets.items():
-        print(f"Traitement de la feuille: {sheet_name}")
-        for index, row in tqdm(sheet_df.iterrows(), total=len(sheet_df), desc=f"Feuille {sheet_name}"):
-            # Extraire le nom scientifique entre parenthèses dans la troisième colonne
-            match = re.search(r'\(([^)]+)\)', row.iloc[2])
-            if match:
-                species_name = match.group(1)
-
-                # Extraire les deux premiers mots du nom scientifique
-                scientific_name_parts = species_name.split()
-                if len(scientific_name_parts) >= 2:
-                    search_name = f"{scientific_name_parts[0]} {scientific_name_parts[1]}"
-                else:
-                    search_name = species_name
-
-                params = {
-                    'scientificName': search_name,
-                    'decimalLatitude': f"{min_latitude},{max_latitude}",
-                    'decimalLongitude': f"{min_longitude},{max_longitude}"
-                    #'stateProvince': 'Québec',  # Filtrer par la province du Québec
-                    #'country': 'CA'  # Filtrer par le code pays du Canada
-                }
-                
-                # Faire une requête à l'API GBIF
-                response = requests.get(gbif_api_url, params=params)
-                
-                # Vérifier le statut de la réponse
-                if response.status_code == 200:
-                    try:
-                        data = response.json()
-                    except requests.exceptions.JSONDecodeError:
-                        print(f"Erreur de décodage JSON pour l'espèce {species_name}. Contenu de la réponse : {response.text}")
-                        continue
-                else:
-                    print(f"Erreur de requête pour l'espèce {species_name}. Statut de la réponse : {response.status_code}")
-                    continue
-                
-                # Vérifier si des occurrences ont été trouvées
-                if 'results' in data:
-                    for occurrence in data['results']:
-                        if 'decimalLatitude' in occurrence and 'decimalLongitude' in occurrence:
-                            result = row.to_dict()  # Convertir la ligne actuelle en dictionnaire
-                            result.update({
-                                'Latitude': occurrence['decimalLatitude'],
-                                'Longitude': occurrence['decimalLongitude']
-                            })
-                            results.append(result)
-                
-                # Pause d'une seconde entre chaque requête
-                time.sleep(0.2)
-except KeyboardInterrupt:
-    print("Interruption du script détectée. Enregistrement des données...")
-finally:
-    # Convertir les résultats en DataFrame
-    results_df = pd.DataFrame(results)
-
-    # Enregistrer les résultats dans un nouveau fichier Excel
-    results_df.to_excel('../coordonnees_especes.xlsx', index=False)
-
-    # Convertir les résultats en GeoDataFrame
-    gdf = gpd.GeoDataFrame(
-        results_df, 
-        geometry=[Point(xy) for xy in zip(results_df['Longitude'], results_df['Latitude'])],
-        crs="EPSG:4326"
+# Taille maximale d'une page de l'API de recherche et limite de pagination (offset + limit)
+page_size = 300
+paging_cap = 100000
+
+# Formats de sortie disponibles et extension des fichiers
+output_extensions = {'gpkg': '.gpkg', 'parquet': '.parquet', 'fgb': '.fgb', 'xlsx': '.xlsx'}
+
+# Répertoire des archives du téléchargement asynchrone et nombre de lignes lues à la fois
+download_dir = 'downloads'
+download_chunk_size = 100000
+
+
+# Extraire les noms de recherche d'une feuille : deux premiers mots du nom scientifique entre parenthèses
+# dans la troisième colonne (NaN si la ligne n'a pas de nom scientifique)
+def extract_search_names(sheet_df):
+    species_names = sheet_df.iloc[:, 2].astype('string').str.extract(r'\(([^)]+)\)', expand=False)
+    return species_names.str.split().str[:2].str.join(' ')
+
+
+# Résoudre un nom scientifique en clé de taxon GBIF avec l'API de correspondance des espèces.
+# Seules les correspondances exactes sont retenues; un synonyme est remplacé par le taxon accepté.
+def match_taxon_key(client, search_name):
+    match = client.get_json(species_match_url, params={'name': search_name, 'strict': 'true'})
+    if match.get('matchType') != 'EXACT':
+        return None
+    return match.get('acceptedUsageKey') or match.get('usageKey')
+
+
+# Résoudre en parallèle chaque nom unique une seule fois et retourner {nom: clé de taxon ou None}
+def resolve_taxon_keys(client, search_names):
+    def resolve(search_name):
+        yield (match_taxon_key(client, search_name),)
+
+    taxon_keys = {}
+    progress = tqdm(total=len(search_names), desc="Résolution des noms")
+    for search_name, result in client.stream(resolve, search_names):
+        if isinstance(result, Exception):
+            report_fetch_error(search_name, result)
+            taxon_keys[search_name] = None
+        elif result is not None:
+            taxon_key = result[0]
+            taxon_keys[search_name] = str(taxon_key) if taxon_key is not None else None
+        else:
+            progress.update(1)
+    progress.close()
+    return taxon_keys
+
+
+# Paramètres de recherche GBIF pour un taxon, dans la géométrie WKT ou, à défaut, dans l'emprise du Québec
+def build_search_params(taxon_key, geometry=None):
+    if geometry:
+        return {'taxonKey': taxon_key, 'geometry': geometry}
+    return {
+        'taxonKey': taxon_key,
+        'decimalLatitude': f"{min_latitude},{max_latitude}",
+        'decimalLongitude': f"{min_longitude},{max_longitude}"
+        #'stateProvince': 'Québec',  # Filtrer par la province du Québec
+        #'country': 'CA'  # Filtrer par le code pays du Canada
+    }
+
+
+# Extraire les coordonnées (latitude, longitude) d'une page de résultats
+def extract_coordinates(occurrences):
+    return [
+        (occurrence['decimalLatitude'], occurrence['decimalLongitude'])
+        for occurrence in occurrences
+        if 'decimalLatitude' in occurrence and 'decimalLongitude' in occurrence
+    ]
+
+
+# Parcourir toutes les pages de résultats de la recherche GBIF et produire les coordonnées page par page.
+# Au-delà de la limite de pagination de l'API de recherche, le téléchargement asynchrone est utilisé
+# si les identifiants GBIF sont définis (GBIF_USER, GBIF_PWD, GBIF_EMAIL).
+def iter_occurrence_pages(client, taxon_key, species_name, geometry=None):
+    params = build_search_params(taxon_key, geometry)
+    offset = 0
+    while True:
+        # La dernière page est raccourcie pour ne pas dépasser la limite de pagination
+        limit = min(page_size, paging_cap - offset)
+        data = client.get_json(gbif_api_url, params={**params, 'limit': limit, 'offset': offset})
+        occurrences = data.get('results', [])
+
+        if offset == 0 and data.get('count', 0) > paging_cap:
+            if gbif_credentials():
+                yield from iter_download_pages(client, taxon_key, geometry)
+                return
+            print(f"{data['count']} occurrences pour l'espèce {species_name} : seules les {paging_cap} premières "
+                  f"sont accessibles sans identifiants GBIF pour le téléchargement asynchrone.")
+
+        yield extract_coordinates(occurrences)
+
+        offset += len(occurrences)
+        if data.get('endOfRecords', True) or not occurrences or offset >= paging_cap:
+            return
+
+
+# Identifiants GBIF nécessaires au téléchargement asynchrone, ou None s'ils ne sont pas définis
+def gbif_credentials():
+    credentials = tuple(os.environ.get(name) for name in ('GBIF_USER', 'GBIF_PWD', 'GBIF_EMAIL'))
+    return credentials if all(credentials) else None
+
+
+# Télécharger toutes les occurrences d'une espèce avec l'API de téléchargement asynchrone et produire
+# les coordonnées par blocs, en lisant le fichier CSV directement dans l'archive
+def iter_download_pages(client, taxon_key, geometry=None):
+    if geometry:
+        spatial_predicates = [{'type': 'within', 'geometry': geometry}]
+    else:
+        spatial_predicates = [
+            {'type': 'greaterThanOrEquals', 'key': 'DECIMAL_LATITUDE', 'value': str(min_latitude)},
+            {'type': 'lessThanOrEquals', 'key': 'DECIMAL_LATITUDE', 'value': str(max_latitude)},
+            {'type': 'greaterThanOrEquals', 'key': 'DECIMAL_LONGITUDE', 'value': str(min_longitude)},
+            {'type': 'lessThanOrEquals', 'key': 'DECIMAL_LONGITUDE', 'value': str(max_longitude)}
+        ]
+    predicate = {
+        'type': 'and',
+        'predicates': [
+            {'type': 'equals', 'key': 'TAXON_KEY', 'value': taxon_key},
+            {'type': 'equals', 'key': 'HAS_COORDINATE', 'value': 'true'},
+            *spatial_predicates
+        ]
+    }
+    download_key = client.request_download(predicate, *gbif_credentials())
+    meta = client.wait_for_download(download_key)
+    if meta['status'] != 'SUCCEEDED':
+        raise RuntimeError(f"Le téléchargement GBIF {download_key} a échoué avec le statut {meta['status']}")
+
+    os.makedirs(download_dir, exist_ok=True)
+    archive_path = client.download_file(meta['downloadLink'], os.path.join(download_dir, f"{download_key}.zip"))
+    with zipfile.ZipFile(archive_path) as archive:
+        with archive.open(f"{download_key}.csv") as csv_file:
+            chunks = pd.read_csv(
+                csv_file, sep='\t', usecols=['decimalLatitude', 'decimalLongitude'],
+                dtype='float64', quoting=csv.QUOTE_NONE, chunksize=download_chunk_size
+            )
+            for chunk in chunks:
+                chunk = chunk.dropna()
+                yield list(zip(chunk['decimalLatitude'].tolist(), chunk['decimalLongitude'].tolist()))
+
+
+# Afficher l'erreur survenue lors de la récolte d'une espèce
+def report_fetch_error(species_name, error):
+    if isinstance(error, requests.exceptions.JSONDecodeError):
+        print(f"Erreur de décodage JSON pour l'espèce {species_name}.")
+    elif isinstance(error, requests.exceptions.HTTPError):
+        print(f"Erreur de requête pour l'espèce {species_name}. Statut de la réponse : {error.response.status_code}")
+    else:
+        print(f"Erreur de requête pour l'espèce {species_name} : {error}")
+
+
+# Assembler par colonnes les occurrences d'un lot : les attributs des espèces sont joints par position
+# et les géométries sont créées en une seule opération
+def assemble_batch(species_df, codes, latitudes, longitudes):
+    results_df = species_df.take(codes).reset_index(drop=True)
+    results_df['Latitude'] = latitudes
+    results_df['Longitude'] = longitudes
+    return gpd.GeoDataFrame(results_df, geometry=gpd.points_from_xy(longitudes, latitudes), crs="EPSG:4326")
+
+
+# Table Arrow des attributs des espèces, au schéma fixe pour tous les lots du fichier GeoParquet
+def species_arrow_table(species_df):
+    species_df = species_df.copy()
+    for column in species_df.columns[species_df.dtypes == object]:
+        species_df[column] = species_df[column].astype('string')
+    return pa.Table.from_pandas(species_df, preserve_index=False)
+
+
+# Métadonnées GeoParquet de la colonne géométrique (points WKB en longitude, latitude)
+geoparquet_metadata = {
+    'version': '1.0.0',
+    'primary_column': 'geometry',
+    'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Point']}}
+}
+
+
+# Convertir une couche GeoPackage en FlatGeobuf en un seul passage GDAL, par blocs d'Arrow lus en continu
+def convert_to_flatgeobuf(gpkg_path, fgb_path, layer='especes'):
+    with pyogrio.raw.open_arrow(gpkg_path, layer=layer, use_pyarrow=True) as (meta, reader):
+        pyogrio.write_arrow(
+            reader, fgb_path, driver='FlatGeobuf', geometry_name=meta['geometry_name'],
+            geometry_type=meta['geometry_type'], crs=meta['crs']
+        )
+
+
+# Écrire les occurrences récoltées dans les formats demandés, lot par lot. FlatGeobuf ne permet pas
+# l'ajout à un fichier existant : les lots sont écrits dans le GeoPackage (ou un GeoPackage temporaire),
+# converti en FlatGeobuf à la fin sans charger toutes les occurrences en mémoire.
+# Les occurrences d'un taxon sont associées à chaque ligne d'espèce résolue en ce taxon.
+def write_results(checkpoint, species_df, species_taxa, output_base, formats):
+    paths = {output_format: output_base + output_extensions[output_format] for output_format in formats}
+    gpkg_path = paths.get('gpkg') or (output_base + '.tmp.gpkg' if 'fgb' in formats else None)
+    links = pd.DataFrame({'species_id': species_taxa, 'code': np.arange(len(species_taxa))}).dropna()
+    species_table = species_arrow_table(species_df) if 'parquet' in formats else None
+    parquet_writer = None
+    excel_writer = None
+    total = 0
+
+    try:
+        for occurrences in checkpoint.iter_occurrences():
+            if occurrences.empty:
+                continue
+            occurrences = occurrences.merge(links, on='species_id')
+            codes = occurrences['code'].to_numpy()
+            latitudes = occurrences['Latitude'].to_numpy()
+            longitudes = occurrences['Longitude'].to_numpy()
+
+            if 'parquet' in formats:
+                table = species_table.take(codes)
+                table = table.append_column('Latitude', pa.array(latitudes))
+                table = table.append_column('Longitude', pa.array(longitudes))
+                table = table.append_column('geometry', pa.array(shapely.to_wkb(shapely.points(longitudes, latitudes))))
+                if parquet_writer is None:
+                    schema = table.schema.with_metadata({'geo': json.dumps(geoparquet_metadata)})
+                    parquet_writer = pq.ParquetWriter(paths['parquet'], schema)
+                parquet_writer.write_table(table.cast(parquet_writer.schema))
+
+            if {'gpkg', 'fgb', 'xlsx'} & set(formats):
+                gdf = assemble_batch(species_df, codes, latitudes, longitudes)
+                if gpkg_path:
+                    gdf.to_file(gpkg_path, layer='especes', driver='GPKG', mode='w' if total == 0 else 'a')
+                if 'xlsx' in formats:
+                    if excel_writer is None:
+                        excel_writer = pd.ExcelWriter(paths['xlsx'])
+                    gdf.drop(columns='geometry').to_excel(
+                        excel_writer, index=False, header=total == 0, startrow=total + 1 if total else 0
+                    )
+            total += len(occurrences)
+            count('entites_ecrites', len(occurrences))
+
+        if 'fgb' in formats and total:
+            convert_to_flatgeobuf(gpkg_path, paths['fgb'])
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+        if excel_writer is not None:
+            excel_writer.close()
+        if 'gpkg' not in formats and gpkg_path and os.path.exists(gpkg_path):
+            os.remove(gpkg_path)
+    return total, list(paths.values()) if total else []
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Occurrences GBIF au Québec des espèces suivies par le CDPNQ.")
+    parser.add_argument('--concurrence', type=int, default=8, help="Nombre maximal de requêtes GBIF simultanées")
+    parser.add_argument('--requetes-par-seconde', type=float, default=10, help="Débit maximal de requêtes GBIF")
+    parser.add_argument('--cache', default='gbif_cache.sqlite', help="Fichier SQLite du cache des réponses HTTP")
+    parser.add_argument('--cache-duree', type=float, default=168, help="Durée de validité du cache (en heures)")
+    parser.add_argument('--cache-taille-max', type=int, default=1024, help="Taille maximale du cache (en Mo)")
+    parser.add_argument('--sans-cache', action='store_true', help="Ne pas utiliser le cache des réponses HTTP")
+    parser.add_argument('--hors-ligne', action='store_true', help="Utiliser seulement les réponses du cache")
+    parser.add_argument('--reprise', default='recolte_cdpnq', help="Répertoire des lots et de la progression de la récolte")
+    parser.add_argument('--taille-lot', type=int, default=50000, help="Nombre d'occurrences écrites par lot")
+    parser.add_argument('--geometrie', help="Filtre spatial : WKT, fichier WKT ou couche vectorielle (par défaut : emprise du Québec)")
+    parser.add_argument('--tolerance', type=float, default=default_tolerance, help="Tolérance de simplification du contour (en degrés)")
+    parser.add_argument('--max-sommets', type=int, default=default_max_vertices, help="Nombre maximal de sommets du contour")
+    parser.add_argument('--sortie', default='../coordonnees_especes', help="Chemin des fichiers de résultats, sans extension")
+    parser.add_argument(
+        '--formats', nargs='+', choices=sorted(output_extensions), default=['gpkg'],
+        help="Formats des résultats : GeoPackage, GeoParquet, FlatGeobuf et/ou Excel (xlsx)"
     )
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    instrumentation.configure_from_args('CDPNQ/GBIF', args)
+    event('parametres', concurrence=args.concurrence, requetes_par_seconde=args.requetes_par_seconde, formats=args.formats)
+    cache = None
+    if not args.sans_cache:
+        cache = ResponseCache(args.cache, ttl=args.cache_duree * 3600, max_bytes=args.cache_taille_max * 1024 ** 2)
+    client = GBIFClient(
+        max_workers=args.concurrence, requests_per_second=args.requetes_par_seconde,
+        cache=cache, offline=args.hors_ligne
+    )
+
+    geometry = read_geometry(args.geometrie, args.tolerance, args.max_sommets) if args.geometrie else None
+
+    # Télécharger le fichier Excel (revalidé avec ETag/Last-Modified lorsqu'il est en cache)
+    with stage('fichier_excel'):
+        content = client.get_content(excel_url)
+        with open(excel_file, 'wb') as file:
+            file.write(content)
+
+    # Lire le fichier Excel et traiter les deux feuilles
+    sheets = pd.read_excel(excel_file, sheet_name=None)
+    species_df = pd.concat(sheets.values(), ignore_index=True)
+    search_names = pd.concat([extract_search_names(sheet_df) for sheet_df in sheets.values()], ignore_index=True)
+
+    # Résoudre une seule fois chaque nom unique en clé de taxon GBIF
+    unique_names = search_names.dropna().unique().tolist()
+    print(f"{len(species_df)} espèces dans les feuilles {', '.join(sheets)}, {len(unique_names)} noms uniques.")
+    with stage('resolution_noms', noms=len(unique_names)):
+        taxon_keys = resolve_taxon_keys(client, unique_names)
+    unresolved = sorted(name for name, taxon_key in taxon_keys.items() if taxon_key is None)
+    if unresolved:
+        print(f"Aucune correspondance exacte dans GBIF pour {len(unresolved)} noms : {', '.join(unresolved)}")
+    species_taxa = search_names.map(taxon_keys)
+
+    # Reprendre la récolte là où elle s'est arrêtée, tant que le fichier des espèces et le filtre spatial
+    # n'ont pas changé
+    source_hash = hashlib.sha256(content + (geometry or '').encode('utf-8')).hexdigest()
+    checkpoint = HarvestCheckpoint(args.reprise, source_hash)
+    completed = checkpoint.completed()
+    if completed:
+        print(f"Reprise de la récolte : {len(completed)} espèces déjà terminées.")
+
+    # Chaque taxon est interrogé une seule fois, même s'il correspond à plusieurs lignes
+    taxa = {}
+    for search_name, taxon_key in taxon_keys.items():
+        if taxon_key is not None and taxon_key not in completed:
+            taxa.setdefault(taxon_key, search_name)
+
+    # Occurrences en attente d'écriture (tableaux de coordonnées) et taxons terminés depuis le dernier lot
+    taxon_ids, latitudes, longitudes = [], array('d'), array('d')
+    finished, counts = {}, {}
+
+    def flush():
+        occurrences = pd.DataFrame({
+            'species_id': taxon_ids,
+            'Latitude': np.frombuffer(latitudes, dtype='float64'),
+            'Longitude': np.frombuffer(longitudes, dtype='float64')
+        })
+        checkpoint.write_batch(occurrences, finished)
+        count('lots_ecrits')
+        taxon_ids.clear()
+        del latitudes[:], longitudes[:]
+        finished.clear()
+
+    try:
+        # Interroger GBIF en parallèle pour tous les taxons, page par page
+        fetch = lambda taxon_key: iter_occurrence_pages(client, taxon_key, taxa[taxon_key], geometry)
+        progress = tqdm(total=len(taxa), desc="Occurrences")
+        with stage('recolte', taxons=len(taxa)):
+            for taxon_key, coordinates in client.stream(fetch, taxa):
+                if isinstance(coordinates, Exception):
+                    # Le taxon n'est pas inscrit comme terminé : il sera récolté de nouveau à la reprise
+                    report_fetch_error(taxa[taxon_key], coordinates)
+                    event('erreur_taxon', taxon=taxon_key, espece=taxa[taxon_key], erreur=str(coordinates))
+                    counts.pop(taxon_key, None)
+                    progress.update(1)
+                    continue
+                if coordinates is None:
+                    finished[taxon_key] = counts.pop(taxon_key, 0)
+                    event('taxon_termine', taxon=taxon_key, occurrences=finished[taxon_key])
+                    progress.update(1)
+                    continue
+                taxon_ids.extend([taxon_key] * len(coordinates))
+                latitudes.extend(latitude for latitude, longitude in coordinates)
+                longitudes.extend(longitude for latitude, longitude in coordinates)
+                counts[taxon_key] = counts.get(taxon_key, 0) + len(coordinates)
+                count('occurrences', len(coordinates))
+                if len(taxon_ids) >= args.taille_lot:
+                    flush()
+        progress.close()
+    except KeyboardInterrupt:
+        print("Interruption du script détectée. Enregistrement des données...")
+    finally:
+        flush()
+        client.close()
+
+        # Assembler les occurrences de tous les taxons terminés avec les attributs des espèces
+        with stage('ecriture_resultats', formats=args.formats):
+            total, paths = write_results(checkpoint, species_df, species_taxa, args.sortie, args.formats)
+        checkpoint.close()
+
+        print(f"Traitement terminé. {total} occurrences trouvées.")
+        if paths:
+            print(f"Les résultats ont été enregistrés dans {', '.join(repr(path) for path in paths)}.")
+        instrumentation.summary()
+        instrumentation.close()
 
-    # Enregistrer les résultats dans un fichier GeoPackage
-    gdf.to_file('../coordonnees_especes.gpkg', layer='especes', driver='GPKG')
 
-    print(f"Traitement terminé. {len(results)} occurrences trouvées.")
-    print("Les résultats ont été enregistrés dans '../coordonnees_especes.xlsx' et '../coordonnees_especes.gpkg'.")
+if __name__ == "__main__":
+    main()
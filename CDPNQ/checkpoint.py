@@ -0,0 +1,91 @@
+# Points de reprise de la récolte CDPNQ → GBIF.
+#
+# Les occurrences sont ajoutées par lots à des fichiers Parquet dans un répertoire de travail, et les
+# espèces terminées sont inscrites dans une petite base SQLite. Une exécution relancée après un arrêt
+# saute les espèces déjà terminées. Chaque occurrence porte le numéro de l'exécution qui l'a récoltée :
+# seules les occurrences de l'exécution où l'espèce s'est terminée sont conservées, ce qui écarte les
+# pages partielles d'une espèce interrompue puis récoltée de nouveau.
+
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+
+class HarvestCheckpoint:
+    def __init__(self, directory, source_hash):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, 'progression.sqlite'))
+        self.connection.executescript(
+            '''CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS species (
+                species_id TEXT PRIMARY KEY,
+                run_id INTEGER NOT NULL,
+                occurrences INTEGER NOT NULL,
+                completed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS parts (name TEXT PRIMARY KEY, rows INTEGER NOT NULL);'''
+        )
+
+        # Recommencer si le fichier des espèces a changé depuis l'exécution précédente
+        if self._get_meta('source_hash') != source_hash:
+            self.connection.execute('DELETE FROM species')
+            self.connection.execute('DELETE FROM parts')
+            self._set_meta('source_hash', source_hash)
+        self.run_id = int(self._get_meta('run_id') or 0) + 1
+        self._set_meta('run_id', str(self.run_id))
+        self.connection.commit()
+
+        # Retirer les fichiers de lots qui n'ont pas été inscrits (écriture interrompue)
+        recorded = {name for (name,) in self.connection.execute('SELECT name FROM parts')}
+        for name in os.listdir(directory):
+            if (name.endswith('.parquet') and name not in recorded) or name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+        self.part_count = len(recorded)
+
+    def _get_meta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    # Identifiants des espèces déjà terminées
+    def completed(self):
+        return {species_id for (species_id,) in self.connection.execute('SELECT species_id FROM species')}
+
+    # Écrire un lot d'occurrences (colonnes species_id, Latitude, Longitude), puis inscrire dans la même
+    # transaction le lot et les espèces terminées {species_id: nombre d'occurrences}
+    def write_batch(self, occurrences, completed_species):
+        name = None
+        if len(occurrences):
+            self.part_count += 1
+            name = f"part-{self.run_id:04d}-{self.part_count:06d}.parquet"
+            path = os.path.join(self.directory, name)
+            occurrences.assign(run_id=self.run_id).to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+
+        with self.connection:
+            if name:
+                self.connection.execute('INSERT INTO parts VALUES (?, ?)', (name, len(occurrences)))
+            now = time.time()
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO species VALUES (?, ?, ?, ?)',
+                [(species_id, self.run_id, count, now) for species_id, count in completed_species.items()]
+            )
+
+    # Parcourir les lots écrits et produire les occurrences des espèces terminées
+    def iter_occurrences(self):
+        completed = pd.DataFrame(
+            self.connection.execute('SELECT species_id, run_id FROM species').fetchall(),
+            columns=['species_id', 'run_id']
+        )
+        for (name,) in self.connection.execute('SELECT name FROM parts ORDER BY name').fetchall():
+            part = pd.read_parquet(os.path.join(self.directory, name))
+            part = part.merge(completed, on=['species_id', 'run_id'])
+            yield part.drop(columns='run_id')
+
+    def close(self):
+        self.connection.close()
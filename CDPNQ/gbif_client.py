@@ -0,0 +1,241 @@
+# Client HTTP partagé pour interroger l'API GBIF : une seule session avec connexions persistantes,
+# un nombre limité de requêtes simultanées, un limiteur de débit par seau à jetons et des
+# reprises avec délai exponentiel pour les réponses 429 et 5xx. Les réponses peuvent être conservées
+# dans un cache persistant (http_cache.py).
+#
+# Les requêtes envoyées, les reprises, les réponses servies par le cache et les octets reçus sont
+# comptés par l'instrumentation partagée (instrumentation.py).
+
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# instrumentation.py se trouve dans le répertoire parent
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+from instrumentation import count
+
+# URL de base de l'API GBIF
+GBIF_API_URL = "https://api.gbif.org/v1"
+
+# Statuts HTTP pour lesquels la requête est reprise
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+# Limiteur de débit par seau à jetons, partagé entre les fils d'exécution
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Attendre qu'un jeton soit disponible, puis le consommer
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GBIFClient:
+    # Si un cache (ResponseCache) est fourni, les réponses JSON et les fichiers revalidés y sont conservés.
+    # En mode hors ligne, seules les réponses du cache sont utilisées, quelle que soit leur date.
+    def __init__(self, max_workers=8, requests_per_second=10, max_retries=5, backoff=1.0, timeout=60,
+                 cache=None, offline=False):
+        self.cache = cache
+        self.offline = offline
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = TokenBucket(requests_per_second)
+
+        # Session partagée : les connexions keep-alive sont réutilisées par tous les fils
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # Délai avant la reprise : en-tête Retry-After s'il est fourni, sinon délai exponentiel avec gigue
+    def _retry_delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return int(retry_after)
+        return self.backoff * (2 ** attempt) + random.uniform(0, self.backoff)
+
+    # Envoyer une requête en respectant le débit et reprendre les erreurs temporaires.
+    # Lève requests.HTTPError ou requests.RequestException si toutes les tentatives échouent.
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            count('requetes')
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                count('reprises')
+                time.sleep(self._retry_delay(attempt))
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                count('reprises')
+                time.sleep(self._retry_delay(attempt, response))
+                continue
+
+            response.raise_for_status()
+            if not kwargs.get('stream'):
+                count('octets_telecharges', len(response.content))
+            return response
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    # Retourner la réponse JSON d'une requête GET, depuis le cache si elle y est encore valide
+    def get_json(self, url, params=None):
+        if self.cache is None:
+            return self.get(url, params=params).json()
+
+        key, normalized_url = self.cache.make_key(url, params)
+        cached = self.cache.get(key)
+        if cached is not None and (cached[3] or self.offline):
+            count('succes_cache')
+            return json.loads(cached[0])
+        if self.offline:
+            raise requests.ConnectionError(f"Réponse absente du cache hors ligne : {normalized_url}")
+
+        response = self.get(url, params=params)
+        data = response.json()
+        self.cache.put(key, normalized_url, response.content)
+        return data
+
+    # Retourner le contenu d'une ressource en le revalidant avec ETag/Last-Modified s'il est en cache :
+    # une réponse 304 réutilise le contenu conservé sans le télécharger de nouveau
+    def get_content(self, url):
+        if self.cache is None:
+            return self.get(url).content
+
+        key, normalized_url = self.cache.make_key(url)
+        cached = self.cache.get(key)
+        if cached is not None and self.offline:
+            count('succes_cache')
+            return cached[0]
+        if self.offline:
+            raise requests.ConnectionError(f"Réponse absente du cache hors ligne : {normalized_url}")
+
+        headers = {}
+        if cached is not None:
+            body, etag, last_modified, fresh = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = self.get(url, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            count('succes_cache')
+            self.cache.refresh(key)
+            return cached[0]
+
+        self.cache.put(
+            key, normalized_url, response.content,
+            etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified')
+        )
+        return response.content
+
+    # Appliquer à chaque élément une fonction génératrice et produire ses résultats au fur et à mesure.
+    # Les paires (élément, page) arrivent dès qu'une page est disponible, puis (élément, None) lorsque
+    # l'élément est terminé, ou (élément, exception) s'il a échoué. La file est bornée : les requêtes
+    # attendent que les pages soient consommées, ce qui garde la mémoire constante.
+    def stream(self, func, items, max_pending=None):
+        pages = queue.Queue(maxsize=max_pending or self.max_workers * 2)
+        stop = threading.Event()
+
+        def put(entry):
+            while not stop.is_set():
+                try:
+                    pages.put(entry, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker(item):
+            try:
+                for page in func(item):
+                    if not put((item, page)):
+                        return
+            except Exception as e:
+                put((item, e))
+                return
+            put((item, None))
+
+        items = list(items)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            for item in items:
+                executor.submit(worker, item)
+            remaining = len(items)
+            while remaining:
+                item, page = pages.get()
+                if page is None or isinstance(page, Exception):
+                    remaining -= 1
+                yield item, page
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # Soumettre une demande de téléchargement asynchrone GBIF et retourner sa clé
+    def request_download(self, predicate, user, password, email, download_format='SIMPLE_CSV'):
+        body = {
+            'creator': user,
+            'notificationAddress': [email],
+            'sendNotification': False,
+            'format': download_format,
+            'predicate': predicate
+        }
+        response = self.request('POST', f"{GBIF_API_URL}/occurrence/download/request", json=body, auth=(user, password))
+        return response.text.strip()
+
+    # Attendre la fin de la préparation d'un téléchargement et retourner ses métadonnées.
+    # L'état change d'une interrogation à l'autre : il est toujours lu sur le serveur, sans le cache.
+    def wait_for_download(self, download_key, poll_interval=30):
+        while True:
+            meta = self.get(f"{GBIF_API_URL}/occurrence/download/{download_key}").json()
+            if meta['status'] not in ('PREPARING', 'RUNNING'):
+                return meta
+            time.sleep(poll_interval)
+
+    # Télécharger un fichier par blocs, sans le charger en mémoire
+    def download_file(self, url, path, chunk_size=1024 * 1024):
+        with self.get(url, stream=True, timeout=(self.timeout, None)) as response:
+            with open(path, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+                    count('octets_telecharges', len(chunk))
+        return path
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,96 @@
+# Cache persistant des réponses HTTP dans une base SQLite.
+#
+# Les réponses sont indexées par l'URL normalisée et ses paramètres triés. Une entrée expire après
+# la durée de vie (TTL) choisie; la taille totale du cache est bornée en retirant les entrées les moins
+# récemment utilisées (LRU). Les en-têtes ETag et Last-Modified sont conservés pour revalider une
+# ressource par une requête conditionnelle.
+
+import hashlib
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode, urlsplit, urlunsplit
+
+
+class ResponseCache:
+    def __init__(self, path, ttl=7 * 24 * 3600, max_bytes=1024 ** 3):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            '''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )'''
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.connection.commit()
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    # Clé de cache : URL normalisée (schéma et hôte en minuscules) et paramètres triés
+    @staticmethod
+    def make_key(url, params=None):
+        parts = urlsplit(url)
+        query = urlencode(sorted((params or {}).items()))
+        normalized = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest(), normalized
+
+    # Retourner l'entrée (body, etag, last_modified, fresh) ou None si elle est absente
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT body, etag, last_modified, fetched_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+        body, etag, last_modified, fetched_at = row
+        fresh = time.time() - fetched_at < self.ttl
+        return body, etag, last_modified, fresh
+
+    def put(self, key, url, body, etag=None, last_modified=None):
+        now = time.time()
+        with self.lock:
+            previous = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if previous:
+                self.total_bytes -= previous[0]
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, url, body, etag, last_modified, now, now, len(body))
+            )
+            self.total_bytes += len(body)
+            self._evict()
+            self.connection.commit()
+
+    # Marquer une entrée revalidée (réponse 304) comme fraîche
+    def refresh(self, key):
+        now = time.time()
+        with self.lock:
+            self.connection.execute('UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE key = ?', (now, now, key))
+            self.connection.commit()
+
+    # Retirer les entrées les moins récemment utilisées jusqu'à respecter la taille maximale
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        rows = self.connection.execute('SELECT key, size FROM responses ORDER BY accessed_at')
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
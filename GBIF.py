@@ -1,88 +1,549 @@
+# Ce script soumet des demandes de téléchargement d'occurrences GBIF, suit leur préparation et télécharge
+# les archives obtenues dans le répertoire 'downloads'.
+#
+# Plusieurs requêtes (régions, pays, catégories UICN) peuvent être définies dans un fichier JSON
+# (--requetes). Elles sont soumises en respectant le nombre de téléchargements simultanés permis par GBIF
+# (--max-simultanes), leur état est vérifié ensemble avec un intervalle qui s'allonge tant que rien ne
+# change, et chaque archive est téléchargée dès qu'elle est prête. Les téléchargements sont repris là où
+# ils se sont arrêtés (en-tête HTTP Range) et l'intégrité des archives est vérifiée. Les clés des demandes
+# soumises sont conservées dans 'downloads/requetes.json' : une exécution relancée reprend leur suivi.
+#
+# Chaque archive téléchargée est ensuite convertie en GeoParquet partitionné par espèce
+# ('downloads/{clé}/speciesKey=.../part-*.parquet'). Le fichier occurrence.txt est lu par blocs directement
+# dans l'archive, sans extraction, et seules les occurrences situées dans la géométrie de la requête sont
+# conservées.
+#
+# Exemple de fichier de requêtes :
+#   [
+#     {"nom": "quebec", "geometrie": "bounding_box_wkt.txt", "pays": ["CA"], "categories": ["NT", "VU", "EN", "CR"]},
+#     {"nom": "ontario", "geometrie": "POLYGON((...))", "pays": ["CA"], "categories": ["EN", "CR"]},
+#     {"nom": "zone_etude", "geometrie": "zone_etude.gpkg", "tolerance": 0.02, "max_sommets": 300}
+#   ]
+#
+# La géométrie est un WKT, un fichier texte contenant un WKT, ou une couche vectorielle : le contour
+# simplifié de la couche est alors calculé avec bounding_box.py (tolérance et nombre de sommets optionnels).
+#
+# --api-url permet d'utiliser un serveur local (mock_gbif_server.py) pour tester sans réseau.
+#
+# --journal écrit les changements d'état des demandes ainsi que la durée et les compteurs (requêtes,
+# reprises, octets téléchargés, entités écrites) de chaque étape dans un journal JSON; --profil et
+# --memoire ajoutent un profil cProfile et le pic de mémoire de chaque étape (instrumentation.py).
+
+import argparse
+import csv
+import hashlib
+import json
 import os
+import shutil
 import time
-from pygbif import occurrences as occ
-
-try:
-    # Demander à l'utilisateur de saisir ses variables d'environnement
-    os.environ['GBIF_USER'] = input("Veuillez saisir votre nom d'utilisateur GBIF: ")
-    os.environ['GBIF_PWD'] = input("Veuillez saisir votre mot de passe GBIF: ")
-    os.environ['GBIF_EMAIL'] = input("Veuillez saisir votre email GBIF: ")
-
-    query = {
-        "type": "and",
-        "predicates": [
-            {
-                "type": "isNotNull",
-                "parameter": "YEAR"
-            },
-            {
-                "type": "not",
-                "predicate": {
-                    "type": "in",
-                    "key": "ISSUE",
-                    "values": ["RECORDED_DATE_INVALID", "TAXON_MATCH_FUZZY", "TAXON_MATCH_HIGHERRANK"]
-                }
-            },
-            {
-                "type": "in",
-                "key": "BASIS_OF_RECORD",
-                "values": ["OBSERVATION", "HUMAN_OBSERVATION", "OCCURRENCE"]
-            },
-            {
-                "type": "equals",
-                "key": "COUNTRY",
-                "value": "CA"
-            },
-            {
-                "type": "equals",
-                "key": "HAS_COORDINATE",
-                "value": "true"
-            },
-            {
-                "type": "equals",
-                "key": "HAS_GEOSPATIAL_ISSUE",
-                "value": "false"
-            },
-            {
-                "type": "within",
-                "geometry": "POLYGON((-56.93492688561576 44.99135832579372, -56.93492688561576 62.58246570128598, -79.76532426607646 62.58246570128598, -79.76532426607646 44.99135832579372, -56.93492688561576 44.99135832579372))"
-            },
-            {
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pandas as pd
+import requests
+import shapely
+
+import instrumentation
+from bounding_box import default_max_vertices, default_tolerance, read_geometry
+from instrumentation import count, event, stage
+
+# Requête par défaut : emprise du Québec, catégories UICN menacées
+default_query = {
+    "nom": "quebec",
+    "geometrie": "POLYGON((-56.93492688561576 44.99135832579372, -56.93492688561576 62.58246570128598, -79.76532426607646 62.58246570128598, -79.76532426607646 44.99135832579372, -56.93492688561576 44.99135832579372))",
+    "pays": ["CA"],
+    "categories": ["NT", "VU", "EN", "CR"]
+}
+
+# Intervalle de vérification de l'état des téléchargements (en secondes)
+min_poll_interval = 10
+max_poll_interval = 300
+
+# États finaux d'une demande échouée : sa clé n'est pas reprise, la demande est soumise de nouveau
+failed_statuses = ('FAILED', 'KILLED', 'CANCELLED')
+
+# Colonnes conservées de occurrence.txt et leurs types (les colonnes absentes de l'archive sont ignorées)
+occurrence_dtypes = {
+    'gbifID': 'int64',
+    'speciesKey': 'Int64',
+    'species': 'string',
+    'scientificName': 'string',
+    'decimalLatitude': 'float64',
+    'decimalLongitude': 'float64',
+    'coordinateUncertaintyInMeters': 'float64',
+    'eventDate': 'string',
+    'year': 'Int64',
+    'countryCode': 'string',
+    'basisOfRecord': 'string',
+    'iucnRedListCategory': 'string'
+}
+
+# Nombre de lignes de occurrence.txt lues à la fois lors de la conversion
+conversion_chunk_size = 250000
+
+# Lignes accumulées pour une espèce avant d'écrire un groupe de lignes dans son fichier Parquet, nombre
+# total de lignes gardées en mémoire avant de vider les plus grosses espèces, et nombre maximal de
+# fichiers Parquet ouverts à la fois
+partition_row_group_size = 100000
+partition_buffer_rows = 1000000
+max_open_writers = 256
+
+# Métadonnées GeoParquet de la colonne géométrique (points WKB en longitude, latitude)
+geoparquet_metadata = {
+    'version': '1.0.0',
+    'primary_column': 'geometry',
+    'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Point']}}
+}
+
+
+# Construire le prédicat de téléchargement GBIF d'une définition de requête et de sa géométrie WKT
+def build_predicate(query, geometry=None):
+    predicates = [
+        {
+            "type": "isNotNull",
+            "parameter": "YEAR"
+        },
+        {
+            "type": "not",
+            "predicate": {
                 "type": "in",
-                "key": "IUCN_RED_LIST_CATEGORY",
-                "values": ["NT", "VU", "EN", "CR"]
+                "key": "ISSUE",
+                "values": ["RECORDED_DATE_INVALID", "TAXON_MATCH_FUZZY", "TAXON_MATCH_HIGHERRANK"]
             }
-        ]
+        },
+        {
+            "type": "in",
+            "key": "BASIS_OF_RECORD",
+            "values": ["OBSERVATION", "HUMAN_OBSERVATION", "OCCURRENCE"]
+        },
+        {
+            "type": "equals",
+            "key": "HAS_COORDINATE",
+            "value": "true"
+        },
+        {
+            "type": "equals",
+            "key": "HAS_GEOSPATIAL_ISSUE",
+            "value": "false"
+        }
+    ]
+    if query.get('pays'):
+        predicates.append({"type": "in", "key": "COUNTRY", "values": query['pays']})
+    if geometry:
+        predicates.append({"type": "within", "geometry": geometry})
+    if query.get('categories'):
+        predicates.append({"type": "in", "key": "IUCN_RED_LIST_CATEGORY", "values": query['categories']})
+    return {"type": "and", "predicates": predicates}
+
+
+# Géométrie WKT d'une définition de requête, ou None si elle n'en a pas
+def query_geometry(query):
+    if not query.get('geometrie'):
+        return None
+    return read_geometry(
+        query['geometrie'], query.get('tolerance', default_tolerance), query.get('max_sommets', default_max_vertices)
+    )
+
+
+# Lire les définitions de requêtes d'un fichier JSON
+def load_queries(path):
+    if not path:
+        return [default_query]
+    with open(path, 'r', encoding='utf-8') as f:
+        queries = json.load(f)
+    names = [query['nom'] for query in queries]
+    if len(set(names)) != len(names):
+        raise ValueError("Chaque requête doit avoir un nom unique.")
+    return queries
+
+
+# Téléchargement GBIF suivi par l'orchestrateur
+class DownloadJob:
+    def __init__(self, query):
+        self.name = query['nom']
+        self.geometry = query_geometry(query)
+        self.predicate = build_predicate(query, self.geometry)
+        self.key = None
+        self.status = 'PENDING'
+        self.meta = None
+        self.path = None
+        self.error = None
+        self.resumed = False
+
+
+class DownloadOrchestrator:
+    def __init__(self, api_url, credentials, download_dir, max_concurrent=3, download_workers=2):
+        self.api_url = api_url.rstrip('/')
+        self.user, self.password, self.email = credentials
+        self.download_dir = download_dir
+        self.max_concurrent = max_concurrent
+        self.session = requests.Session()
+        self.download_executor = ThreadPoolExecutor(max_workers=download_workers)
+
+    # Soumettre une demande de téléchargement et conserver sa clé
+    def submit(self, job):
+        body = {
+            "creator": self.user,
+            "notificationAddress": [self.email],
+            "sendNotification": False,
+            "format": "DWCA",
+            "predicate": job.predicate
+        }
+        count('requetes')
+        response = self.session.post(
+            f"{self.api_url}/occurrence/download/request", json=body, auth=(self.user, self.password), timeout=60
+        )
+        response.raise_for_status()
+        job.key = response.text.strip()
+        job.status = 'PREPARING'
+        event('demande_soumise', requete=job.name, cle=job.key)
+        print(f"[{job.name}] Your download key is {job.key}")
+
+    # Mettre à jour l'état d'un téléchargement; retourne True si l'état a changé
+    def poll(self, job):
+        count('requetes')
+        response = self.session.get(f"{self.api_url}/occurrence/download/{job.key}", timeout=60)
+        response.raise_for_status()
+        job.meta = response.json()
+        changed = job.meta['status'] != job.status
+        job.status = job.meta['status']
+        if changed:
+            event('etat_demande', requete=job.name, cle=job.key, etat=job.status)
+        return changed
+
+    # Télécharger une archive par blocs, en reprenant le fichier partiel après une interruption,
+    # puis vérifier son intégrité
+    def fetch(self, job, max_attempts=5):
+        path = os.path.join(self.download_dir, f"{job.key}.zip")
+        partial_path = path + '.part'
+        url = job.meta.get('downloadLink') or f"{self.api_url}/occurrence/download/request/{job.key}.zip"
+
+        for attempt in range(max_attempts):
+            offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+            headers = {'Range': f"bytes={offset}-"} if offset else {}
+            count('requetes')
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=(60, 300)) as response:
+                    # 416 : le fichier partiel est déjà complet
+                    if response.status_code != 416:
+                        response.raise_for_status()
+                        # 200 : le serveur ignore la plage demandée, recommencer depuis le début
+                        mode = 'ab' if response.status_code == 206 else 'wb'
+                        with open(partial_path, mode) as file:
+                            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                                file.write(chunk)
+                                count('octets_telecharges', len(chunk))
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == max_attempts - 1:
+                    raise
+                count('reprises')
+                event('reprise_telechargement', requete=job.name, cle=job.key, octets=offset, erreur=str(e))
+                print(f"[{job.name}] Téléchargement interrompu ({e}), reprise à partir de {offset} octets...")
+                time.sleep(2 ** attempt)
+
+        verify_archive(partial_path, job.meta)
+        os.replace(partial_path, path)
+        job.path = path
+        event('archive_telechargee', requete=job.name, cle=job.key, octets=os.path.getsize(path))
+        return path
+
+    # Clés des demandes déjà soumises, pour reprendre le suivi après un arrêt sans soumettre de nouveau
+    def load_state(self):
+        path = os.path.join(self.download_dir, 'requetes.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_state(self, jobs):
+        state = {
+            job.name: {'key': job.key, 'predicate': job.predicate, 'status': job.status}
+            for job in jobs if job.key and job.status not in failed_statuses
+        }
+        with open(os.path.join(self.download_dir, 'requetes.json'), 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2)
+
+    # Soumettre, suivre et télécharger toutes les requêtes
+    def run(self, jobs):
+        os.makedirs(self.download_dir, exist_ok=True)
+        state = self.load_state()
+        pending = []
+        running = []
+        downloads = {}
+        poll_interval = min_poll_interval
+
+        # Reprendre les demandes déjà soumises pour la même requête
+        for job in jobs:
+            previous = state.get(job.name)
+            if previous and previous['predicate'] == job.predicate and previous.get('status') not in failed_statuses:
+                job.key = previous['key']
+                if os.path.exists(os.path.join(self.download_dir, f"{job.key}.zip")):
+                    job.status = 'SUCCEEDED'
+                    job.path = os.path.join(self.download_dir, f"{job.key}.zip")
+                    print(f"[{job.name}] Archive déjà téléchargée : {job.path}")
+                    continue
+                job.status = 'PREPARING'
+                job.resumed = True
+                running.append(job)
+                print(f"[{job.name}] Reprise du suivi du téléchargement {job.key}")
+            else:
+                pending.append(job)
+
+        try:
+            while pending or running:
+                # Soumettre de nouvelles demandes sans dépasser le nombre de téléchargements simultanés
+                while pending and len(running) < self.max_concurrent:
+                    job = pending.pop(0)
+                    try:
+                        self.submit(job)
+                        running.append(job)
+                    except requests.RequestException as e:
+                        job.status, job.error = 'FAILED', str(e)
+                        print(f"[{job.name}] Échec de la soumission : {e}")
+                self.save_state(jobs)
+
+                if not running:
+                    continue
+
+                # Vérifier l'état de toutes les demandes en cours
+                time.sleep(poll_interval)
+                any_changed = False
+                for job in list(running):
+                    try:
+                        any_changed |= self.poll(job)
+                    except requests.RequestException as e:
+                        print(f"[{job.name}] Erreur lors de la vérification de l'état : {e}")
+                        continue
+                    if job.status in ('PREPARING', 'RUNNING'):
+                        continue
+                    running.remove(job)
+                    if job.status == 'SUCCEEDED':
+                        # Télécharger l'archive sans attendre les autres demandes
+                        print(f"[{job.name}] Download ready. Fetching {job.key}.zip...")
+                        downloads[job.name] = (job, self.download_executor.submit(self.fetch, job))
+                    elif job.resumed:
+                        # Une demande reprise d'une exécution précédente a échoué : la soumettre de nouveau
+                        print(f"[{job.name}] La demande {job.key} a échoué ({job.status}), nouvelle soumission...")
+                        job.key, job.meta, job.resumed = None, None, False
+                        pending.append(job)
+                    else:
+                        print(f"[{job.name}] Download failed with status: {job.status}")
+
+                # Vérifier plus souvent lorsque l'état change, moins souvent sinon
+                if any_changed:
+                    poll_interval = min_poll_interval
+                else:
+                    poll_interval = min(poll_interval * 1.5, max_poll_interval)
+                if running:
+                    statuses = ', '.join(f"{job.name}={job.status}" for job in running)
+                    print(f"Download status: {statuses}. Waiting for {poll_interval:.0f} seconds...")
+
+            for name, (job, future) in downloads.items():
+                try:
+                    future.result()
+                    print(f"[{name}] Download completed successfully: {job.path}")
+                except (requests.RequestException, IOError, ValueError) as e:
+                    job.status, job.error = 'DOWNLOAD_FAILED', str(e)
+                    print(f"[{name}] Échec du téléchargement (relancer le script pour reprendre) : {e}")
+            self.save_state(jobs)
+        finally:
+            self.download_executor.shutdown(wait=True, cancel_futures=True)
+            self.session.close()
+        return jobs
+
+
+# Vérifier la taille annoncée, la somme de contrôle MD5 si elle est fournie, et le CRC de chaque fichier de l'archive
+def verify_archive(path, meta):
+    expected_size = meta.get('size')
+    if expected_size and os.path.getsize(path) != expected_size:
+        size = os.path.getsize(path)
+        os.remove(path)
+        raise IOError(f"Taille inattendue pour {path} : {size} octets au lieu de {expected_size}")
+
+    expected_checksum = meta.get('checksum')
+    if expected_checksum:
+        digest = hashlib.md5()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        if digest.hexdigest() != expected_checksum.lower():
+            os.remove(path)
+            raise IOError(f"Somme de contrôle invalide pour {path}")
+
+    with zipfile.ZipFile(path) as archive:
+        corrupted = archive.testzip()
+    if corrupted:
+        os.remove(path)
+        raise IOError(f"Fichier corrompu dans l'archive {path} : {corrupted}")
+
+
+# Lire occurrence.txt par blocs directement dans l'archive, en ne gardant que les colonnes utiles et les
+# occurrences situées dans la géométrie WKT (toutes les occurrences géoréférencées si elle est absente)
+def iter_occurrence_chunks(archive_path, geometry=None, chunk_size=conversion_chunk_size):
+    polygon = shapely.from_wkt(geometry) if geometry else None
+    if polygon is not None:
+        shapely.prepare(polygon)
+        min_x, min_y, max_x, max_y = polygon.bounds
+
+    with zipfile.ZipFile(archive_path) as archive:
+        with archive.open('occurrence.txt') as occurrence_file:
+            chunks = pd.read_csv(
+                occurrence_file, sep='\t', quoting=csv.QUOTE_NONE, usecols=lambda column: column in occurrence_dtypes,
+                dtype=occurrence_dtypes, chunksize=chunk_size
+            )
+            for chunk in chunks:
+                chunk = chunk.dropna(subset=['decimalLatitude', 'decimalLongitude'])
+                x = chunk['decimalLongitude'].to_numpy()
+                y = chunk['decimalLatitude'].to_numpy()
+                if polygon is not None:
+                    # Écarter d'abord les points hors de l'emprise, puis tester l'inclusion dans le polygone
+                    candidates = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+                    candidates[candidates] = shapely.contains_xy(polygon, x[candidates], y[candidates])
+                    chunk, x, y = chunk[candidates], x[candidates], y[candidates]
+                yield chunk, x, y
+
+
+# Écriture des partitions 'speciesKey=...' : les lignes de chaque espèce sont accumulées puis ajoutées
+# par groupes de lignes à un seul fichier Parquet par espèce. Un fichier n'est fermé que si trop de
+# fichiers sont ouverts; l'espèce reçoit alors un nouveau fichier (part-00001, ...) à sa prochaine écriture.
+class PartitionWriter:
+    def __init__(self, directory):
+        self.directory = directory
+        self.schema_metadata = {'geo': json.dumps(geoparquet_metadata)}
+        self.buffers = {}  # espèce -> tables en attente
+        self.buffered_rows = {}  # espèce -> lignes en attente
+        self.writers = {}  # espèce -> ParquetWriter ouvert, du moins au plus récemment utilisé
+        self.file_counts = {}  # espèce -> fichiers créés
+
+    def add(self, species_key, table):
+        self.buffers.setdefault(species_key, []).append(table)
+        self.buffered_rows[species_key] = self.buffered_rows.get(species_key, 0) + table.num_rows
+        if self.buffered_rows[species_key] >= partition_row_group_size:
+            self.flush(species_key)
+        # Limiter la mémoire : vider les espèces les plus grosses jusqu'à la moitié de la limite
+        if sum(self.buffered_rows.values()) > partition_buffer_rows:
+            for key in sorted(self.buffered_rows, key=self.buffered_rows.get, reverse=True):
+                self.flush(key)
+                if sum(self.buffered_rows.values()) <= partition_buffer_rows // 2:
+                    break
+
+    def flush(self, species_key):
+        tables = self.buffers.pop(species_key, None)
+        self.buffered_rows.pop(species_key, None)
+        if not tables:
+            return
+        table = pa.concat_tables(tables)
+        writer = self.writers.pop(species_key, None)
+        if writer is None:
+            if len(self.writers) >= max_open_writers:
+                oldest = next(iter(self.writers))
+                self.writers.pop(oldest).close()
+            partition_dir = os.path.join(self.directory, f"speciesKey={species_key}")
+            os.makedirs(partition_dir, exist_ok=True)
+            file_number = self.file_counts.get(species_key, 0)
+            self.file_counts[species_key] = file_number + 1
+            schema = table.schema.with_metadata({**(table.schema.metadata or {}), **self.schema_metadata})
+            writer = pq.ParquetWriter(os.path.join(partition_dir, f"part-{file_number:05d}.parquet"), schema)
+        writer.write_table(table.cast(writer.schema))
+        self.writers[species_key] = writer
+
+    def close(self):
+        for species_key in list(self.buffers):
+            self.flush(species_key)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+# Convertir une archive Darwin Core en GeoParquet partitionné par espèce : un fichier par espèce (en
+# général), dans des répertoires 'speciesKey=...' lisibles comme un seul jeu de données (pyarrow, geopandas).
+# Le répertoire est écrit sous un nom temporaire puis renommé, pour ne jamais laisser une conversion partielle.
+def convert_archive(archive_path, output_dir, geometry=None, chunk_size=conversion_chunk_size):
+    temporary_dir = output_dir + '.tmp'
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    os.makedirs(temporary_dir)
+    partitions = PartitionWriter(temporary_dir)
+    total = 0
+
+    try:
+        for chunk, x, y in iter_occurrence_chunks(archive_path, geometry, chunk_size):
+            if chunk.empty:
+                continue
+            chunk = chunk.assign(geometry=shapely.to_wkb(shapely.points(x, y)))
+            species_keys = chunk.pop('speciesKey').astype('string').fillna('__HIVE_DEFAULT_PARTITION__')
+            for species_key, part in chunk.groupby(species_keys.to_numpy(), sort=False):
+                partitions.add(species_key, pa.Table.from_pandas(part, preserve_index=False))
+            total += len(chunk)
+            count('entites_ecrites', len(chunk))
+    finally:
+        partitions.close()
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(temporary_dir, output_dir)
+    return total
+
+
+# Identifiants GBIF : variables d'environnement, sinon saisie par l'utilisateur
+def get_credentials():
+    prompts = {
+        'GBIF_USER': "Veuillez saisir votre nom d'utilisateur GBIF: ",
+        'GBIF_PWD': "Veuillez saisir votre mot de passe GBIF: ",
+        'GBIF_EMAIL': "Veuillez saisir votre email GBIF: "
     }
+    for name, prompt in prompts.items():
+        if not os.environ.get(name):
+            os.environ[name] = input(prompt)
+    return os.environ['GBIF_USER'], os.environ['GBIF_PWD'], os.environ['GBIF_EMAIL']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Télécharger des occurrences GBIF pour une ou plusieurs requêtes.")
+    parser.add_argument('--requetes', help="Fichier JSON des définitions de requêtes (par défaut : Québec)")
+    parser.add_argument('--max-simultanes', type=int, default=3, help="Nombre maximal de téléchargements GBIF simultanés")
+    parser.add_argument('--api-url', default='https://api.gbif.org/v1', help="URL de l'API GBIF (ou d'un serveur local de test)")
+    parser.add_argument(
+        '--repertoire', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads'),
+        help="Répertoire des archives téléchargées"
+    )
+    parser.add_argument('--sans-conversion', action='store_true', help="Ne pas convertir les archives en GeoParquet")
+    parser.add_argument(
+        '--taille-bloc', type=int, default=conversion_chunk_size,
+        help="Nombre de lignes de occurrence.txt lues à la fois lors de la conversion"
+    )
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    try:
+        args = parse_args(argv)
+        instrumentation.configure_from_args('GBIF', args)
+        jobs = [DownloadJob(query) for query in load_queries(args.requetes)]
+        orchestrator = DownloadOrchestrator(args.api_url, get_credentials(), args.repertoire, args.max_simultanes)
+        with stage('telechargements', requetes=len(jobs)):
+            orchestrator.run(jobs)
+        if not args.sans_conversion:
+            for job in jobs:
+                if not job.path:
+                    continue
+                output_dir = os.path.splitext(job.path)[0]
+                if os.path.isdir(output_dir):
+                    print(f"[{job.name}] Archive déjà convertie : {output_dir}")
+                    continue
+                with stage('conversion', requete=job.name):
+                    total = convert_archive(job.path, output_dir, job.geometry, args.taille_bloc)
+                print(f"[{job.name}] {total} occurrences converties en GeoParquet : {output_dir}")
+    except KeyboardInterrupt:
+        print("\nOpération interrompue par l'utilisateur.")
+    except Exception as e:
+        print(f"Une erreur est survenue: {e}")
+    finally:
+        instrumentation.summary()
+        instrumentation.close()
+
 
-    # Obtenir la clé de téléchargement
-    download_key = occ.download(query)
-    print(f"Your download key is {download_key}")
-
-    # Extraire la clé de téléchargement du tuple
-    download_key = download_key[0] if isinstance(download_key, tuple) else download_key
-
-    # Vérifier périodiquement l'état du téléchargement
-    status = occ.download_meta(download_key)['status']
-    while status in ['PREPARING', 'RUNNING']:
-        print(f"Download status: {status}. Waiting for 30 seconds...")
-        time.sleep(30)
-        status = occ.download_meta(download_key)['status']
-
-    if status == 'SUCCEEDED':
-        # Créer le répertoire de téléchargement s'il n'existe pas
-        download_dir = os.path.join(os.path.dirname(__file__), 'downloads')
-        if not os.path.exists(download_dir):
-            os.makedirs(download_dir)
-        
-        # Télécharger les données
-        download_path = os.path.join(download_dir, f'{download_key}.zip')
-        occ.download_get(download_key, path=download_path)
-        print("Download completed successfully.")
-    else:
-        print(f"Download failed with status: {status}")
-
-except KeyboardInterrupt:
-    print("\nOpération interrompue par l'utilisateur.")
-except Exception as e:
-    print(f"Une erreur est survenue: {e}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Générateurs de données synthétiques pour les bancs d'essai. Chaque générateur reçoit une graine : les
+# mêmes paramètres produisent toujours les mêmes données, ce qui rend les résultats comparables d'une
+# exécution à l'autre.
+
+import csv
+import json
+import math
+import random
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+# Syllabes des noms d'espèces générés
+syllables = ['ra', 'ne', 'to', 'li', 'ca', 'mo', 'su', 'pe', 'di', 'ga', 'vo', 'ri', 'ba', 'lu', 'sti', 'cor']
+
+# Catégories UICN attribuées aux espèces générées
+iucn_categories = ['LC', 'NT', 'VU', 'EN', 'CR']
+
+
+# Couche de blocs de récolte : quadrilatères irréguliers de 5 à 40 ha, regroupés en chantiers. La densité
+# est le nombre moyen de blocs par km² sur l'étendue couverte : plus elle est élevée, plus les blocs
+# voisins sont nombreux à la distance des tenants.
+def generate_harvest_blocks(count, density=2.0, seed=0, crs='EPSG:32198'):
+    rng = np.random.default_rng(seed)
+    side = math.sqrt(count / density) * 1000
+
+    # Centres des chantiers, puis blocs répartis autour de chacun
+    site_count = max(1, count // 20)
+    sites = rng.uniform(0, side, size=(site_count, 2))
+    centers = sites[rng.integers(0, site_count, count)] + rng.normal(0, side / math.sqrt(site_count) / 3, (count, 2))
+
+    # Quatre sommets à des angles et rayons perturbés autour de chaque centre
+    areas = rng.uniform(5, 40, count) * 10000
+    radii = np.sqrt(areas / 2)
+    angles = rng.uniform(0, 2 * math.pi, (count, 1)) + np.arange(4) * math.pi / 2 + rng.uniform(-0.3, 0.3, (count, 4))
+    scales = radii[:, None] * rng.uniform(0.8, 1.2, (count, 4))
+    xs = centers[:, [0]] + scales * np.cos(angles)
+    ys = centers[:, [1]] + scales * np.sin(angles)
+    coordinates = np.stack([xs, ys], axis=-1)
+    geometries = shapely.polygons(np.concatenate([coordinates, coordinates[:, :1]], axis=1))
+
+    return gpd.GeoDataFrame(
+        {
+            'NOM_BLOC': [f"BLOC-{index:07d}" for index in range(count)],
+            'ANNEE': rng.integers(2020, 2026, count)
+        },
+        geometry=geometries, crs=crs
+    )
+
+
+# Noms scientifiques uniques (genre + épithète)
+def generate_species_names(count, seed=0):
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        genus = ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).capitalize()
+        epithet = ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 5)))
+        names.add(f"{genus} {epithet}")
+    return sorted(names)
+
+
+# Liste UICN au format de l'API (result avec scientific_name et category)
+def generate_iucn_json(path, species_names, seed=0):
+    rng = random.Random(seed)
+    result = [{'scientific_name': name, 'category': rng.choice(iucn_categories)} for name in species_names]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'result': result}, f)
+
+
+# Export d'occurrences en CSV. Une part des noms porte un auteur, un rang infraspécifique ou une faute de
+# frappe (variant_ratio), et une part des espèces est absente de la liste UICN (unknown_ratio).
+def generate_species_csv(path, rows, species_names, seed=0, variant_ratio=0.2, unknown_ratio=0.1):
+    rng = random.Random(seed)
+    unknown_names = [f"Inconnu {index}" for index in range(max(1, len(species_names) // 10))]
+
+    def variant(name):
+        choice = rng.randrange(3)
+        if choice == 0:
+            return f"{name} (Auteur, {rng.randint(1750, 2000)})"
+        if choice == 1:
+            return f"{name} subsp. borealis"
+        position = rng.randrange(1, len(name))
+        return name[:position] + 'q' + name[position + 1:]
+
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['gbifID', 'species', 'decimalLatitude', 'decimalLongitude'])
+        for gbif_id in range(rows):
+            draw = rng.random()
+            if draw < unknown_ratio:
+                name = rng.choice(unknown_names)
+            elif draw < unknown_ratio + variant_ratio:
+                name = variant(rng.choice(species_names))
+            else:
+                name = rng.choice(species_names)
+            writer.writerow([gbif_id, name, f"{rng.uniform(45, 62):.5f}", f"{rng.uniform(-79.5, -57):.5f}"])
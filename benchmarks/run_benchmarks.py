@@ -0,0 +1,297 @@
+# Bancs d'essai des outils du dépôt sur des données synthétiques générées avec une graine fixe.
+#
+# Chaque banc d'essai est exécuté à plusieurs tailles (--taille multiplie les tailles de base). Pour chaque
+# taille, le meilleur temps de --repetitions exécutions est retenu, puis une exécution de plus mesure le
+# pic de mémoire Python avec tracemalloc (les allocations natives de GEOS, GDAL ou Arrow et celles des
+# processus de travail n'y sont pas comptées). Les résultats (débit, pic de mémoire, exposant de mise à
+# l'échelle entre deux tailles) sont enregistrés en JSON et peuvent être comparés à ceux d'une exécution
+# précédente (--comparer) pour repérer les régressions.
+#
+# Les récoltes GBIF sont mesurées contre le serveur local mock_gbif_server.py : aucun accès réseau.
+#
+# Exemples :
+#   python benchmarks/run_benchmarks.py --taille petit --sortie resultats.json
+#   python benchmarks/run_benchmarks.py --bancs tenants jointure --comparer resultats.json
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# Les barres de progression des récoltes fausseraient les mesures
+os.environ.setdefault('TQDM_DISABLE', '1')
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root_dir, 'CDPNQ'))
+sys.path.insert(0, root_dir)
+
+import bounding_box
+import compare_species
+import GBIF
+import mock_gbif_server
+import tenants_engine
+from gbif_client import GBIFClient
+from generators import (generate_harvest_blocks, generate_iucn_json, generate_species_csv,
+                        generate_species_names)
+
+# CDPNQ/GBIF.py porte le même nom de module que GBIF.py : il est chargé sous un autre nom
+spec = importlib.util.spec_from_file_location('cdpnq_gbif', os.path.join(root_dir, 'CDPNQ', 'GBIF.py'))
+cdpnq_gbif = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cdpnq_gbif)
+
+# Tailles de base de chaque banc d'essai, multipliées selon --taille
+base_sizes = {
+    'tenants': [1000, 2000, 4000],
+    'tenants_parallele': [1000, 2000, 4000],
+    'jointure': [100000, 200000, 400000],
+    'jointure_approximative': [100000, 200000, 400000],
+    'emprise_metadonnees': [2000, 4000, 8000],
+    'emprise_complete': [2000, 4000, 8000],
+    'contour': [2000, 4000, 8000],
+    'recherche_gbif': [20, 40, 80],
+    'telechargement_gbif': [50000, 100000, 200000]
+}
+size_factors = {'petit': 1, 'moyen': 5, 'grand': 25}
+
+# Écart relatif au-delà duquel un temps est signalé comme une régression
+regression_threshold = 1.2
+
+
+# Chaque banc d'essai prépare ses données dans workdir et retourne une fonction qui exécute l'opération
+# mesurée et retourne le nombre d'éléments traités. Un attribut close de cette fonction libère les
+# ressources du banc d'essai (serveur local).
+
+def bench_tenants(size, workdir, workers=1):
+    blocks = generate_harvest_blocks(size, seed=size)
+    return lambda: len(tenants_engine.compute_tenants(blocks, 'NOM_BLOC', 60, workers=workers))
+
+
+def bench_tenants_parallel(size, workdir):
+    return bench_tenants(size, workdir, workers=min(4, os.cpu_count() or 1))
+
+
+def bench_species_join(size, workdir, fuzzy=False):
+    names = generate_species_names(max(100, size // 200), seed=1)
+    json_path = os.path.join(workdir, 'iucn.json')
+    csv_path = os.path.join(workdir, 'especes.csv')
+    generate_iucn_json(json_path, names, seed=1)
+    generate_species_csv(csv_path, size, names, seed=size)
+    output_path = os.path.join(workdir, 'especes_categories.parquet')
+
+    def run():
+        # L'index est reconstruit à chaque exécution : le coût mesuré inclut la mise en correspondance
+        matcher = compare_species.load_species_matcher(json_path)[0] if fuzzy else None
+        counts, not_found = compare_species.compare_species_chunked(csv_path, json_path, output_path, matcher=matcher)
+        return sum(counts.values())
+    return run
+
+
+def bench_species_join_fuzzy(size, workdir):
+    return bench_species_join(size, workdir, fuzzy=True)
+
+
+def bench_bounding_box(size, workdir, footprint=False, full_read=False):
+    layer_path = os.path.join(workdir, 'blocs.gpkg')
+    generate_harvest_blocks(size, seed=size).to_file(layer_path, layer='blocs')
+
+    def run():
+        bounding_box.get_layer_geometry_wkt(layer_path, footprint=footprint, full_read=full_read)
+        return size
+    return run
+
+
+def bench_bounding_box_full(size, workdir):
+    return bench_bounding_box(size, workdir, full_read=True)
+
+
+def bench_footprint(size, workdir):
+    return bench_bounding_box(size, workdir, footprint=True)
+
+
+# Récolte CDPNQ : résolution des noms puis recherche paginée de toutes les occurrences de chaque taxon
+def bench_gbif_search(size, workdir):
+    server, url = mock_gbif_server.start_mock_server(occurrences_per_taxon=1000)
+    cdpnq_gbif.gbif_api_url = f"{url}/occurrence/search"
+    cdpnq_gbif.species_match_url = f"{url}/species/match"
+    names = generate_species_names(size, seed=2)
+
+    def run():
+        client = GBIFClient(max_workers=8, requests_per_second=1000)
+        try:
+            taxon_keys = cdpnq_gbif.resolve_taxon_keys(client, names)
+            taxa = {taxon_key: name for name, taxon_key in taxon_keys.items() if taxon_key}
+            fetch = lambda taxon_key: cdpnq_gbif.iter_occurrence_pages(client, taxon_key, taxa[taxon_key])
+            return sum(len(page) for taxon_key, page in client.stream(fetch, taxa) if isinstance(page, list))
+        finally:
+            client.close()
+    run.close = server.shutdown
+    return run
+
+
+# Téléchargement GBIF.py : soumission, suivi, téléchargement de l'archive et conversion en GeoParquet
+def bench_gbif_download(size, workdir):
+    server, url = mock_gbif_server.start_mock_server(occurrences=size, polls_before_success=2)
+    GBIF.min_poll_interval = 0.05
+    GBIF.max_poll_interval = 0.2
+    os.environ.update({name: os.environ.get(name) or 'banc' for name in ('GBIF_USER', 'GBIF_PWD', 'GBIF_EMAIL')})
+    query = dict(GBIF.default_query)
+
+    def run():
+        download_dir = tempfile.mkdtemp(dir=workdir)
+        job = GBIF.DownloadJob(query)
+        orchestrator = GBIF.DownloadOrchestrator(url, GBIF.get_credentials(), download_dir)
+        orchestrator.run([job])
+        return GBIF.convert_archive(job.path, os.path.splitext(job.path)[0], job.geometry)
+    run.close = server.shutdown
+    return run
+
+
+benchmarks = {
+    'tenants': bench_tenants,
+    'tenants_parallele': bench_tenants_parallel,
+    'jointure': bench_species_join,
+    'jointure_approximative': bench_species_join_fuzzy,
+    'emprise_metadonnees': bench_bounding_box,
+    'emprise_complete': bench_bounding_box_full,
+    'contour': bench_footprint,
+    'recherche_gbif': bench_gbif_search,
+    'telechargement_gbif': bench_gbif_download
+}
+
+
+# Exécuter une fonction sans afficher ses messages
+def run_quietly(run):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return run()
+
+
+# Mesurer un banc d'essai à une taille : meilleur temps, débit et pic de mémoire Python
+def measure(name, size, repetitions, track_memory=True):
+    workdir = tempfile.mkdtemp(prefix=f"banc_{name}_")
+    run = None
+    try:
+        run = run_quietly(lambda: benchmarks[name](size, workdir))
+        timings = []
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            items = run_quietly(run)
+            timings.append(time.perf_counter() - start)
+
+        peak_mb = None
+        if track_memory:
+            tracemalloc.start()
+            try:
+                run_quietly(run)
+                peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            finally:
+                tracemalloc.stop()
+    finally:
+        if hasattr(run, 'close'):
+            run.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    seconds = min(timings)
+    return {
+        'taille': size,
+        'elements': items,
+        'secondes': seconds,
+        'elements_par_seconde': items / seconds if seconds else None,
+        'pic_memoire_mo': peak_mb
+    }
+
+
+# Exposant de mise à l'échelle entre deux tailles successives (1 : linéaire, 2 : quadratique)
+def scaling_exponents(measurements):
+    exponents = []
+    for previous, current in zip(measurements, measurements[1:]):
+        if previous['secondes'] > 0 and current['taille'] != previous['taille']:
+            exponents.append(
+                math.log(current['secondes'] / previous['secondes']) / math.log(current['taille'] / previous['taille'])
+            )
+    return exponents
+
+
+# Comparer les temps à ceux d'un fichier de résultats précédent et afficher les écarts
+def compare_results(results, previous_path):
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = json.load(f)['bancs']
+    regressions = 0
+    for name, result in results.items():
+        previous_timings = {entry['taille']: entry['secondes'] for entry in previous.get(name, {}).get('mesures', [])}
+        for entry in result['mesures']:
+            if entry['taille'] not in previous_timings:
+                continue
+            ratio = entry['secondes'] / previous_timings[entry['taille']]
+            flag = ' RÉGRESSION' if ratio > regression_threshold else ''
+            regressions += bool(flag)
+            print(f"{name} ({entry['taille']}) : {ratio:.2f} × le temps précédent{flag}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=root_dir, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bancs d'essai des outils sur des données synthétiques.")
+    parser.add_argument('--bancs', nargs='+', choices=sorted(benchmarks), default=sorted(benchmarks), help="Bancs d'essai à exécuter")
+    parser.add_argument('--taille', choices=sorted(size_factors), default='petit', help="Facteur appliqué aux tailles de base")
+    parser.add_argument('--repetitions', type=int, default=3, help="Nombre d'exécutions par taille (le meilleur temps est retenu)")
+    parser.add_argument('--sans-memoire', action='store_true', help="Ne pas mesurer le pic de mémoire")
+    parser.add_argument('--sortie', default='resultats_bancs.json', help="Fichier JSON des résultats")
+    parser.add_argument('--comparer', help="Fichier JSON de résultats précédents à comparer")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    factor = size_factors[args.taille]
+    results = {}
+
+    for name in args.bancs:
+        measurements = []
+        for size in (base_size * factor for base_size in base_sizes[name]):
+            entry = measure(name, size, args.repetitions, not args.sans_memoire)
+            measurements.append(entry)
+            memory = f", pic {entry['pic_memoire_mo']:.1f} Mo" if entry['pic_memoire_mo'] is not None else ''
+            print(f"{name} ({size}) : {entry['secondes']:.3f} s, {entry['elements_par_seconde']:.0f} éléments/s{memory}")
+        results[name] = {'mesures': measurements, 'exposants': scaling_exponents(measurements)}
+
+    report = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'plateforme': platform.platform(),
+        'processeurs': os.cpu_count(),
+        'taille': args.taille,
+        'repetitions': args.repetitions,
+        'bancs': results
+    }
+    with open(args.sortie, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Résultats enregistrés dans {args.sortie}")
+
+    if args.comparer:
+        regressions = compare_results(results, args.comparer)
+        if regressions:
+            print(f"{regressions} mesures plus de {regression_threshold} fois plus lentes qu'à l'exécution précédente.")
+
+
+if __name__ == "__main__":
+    main()
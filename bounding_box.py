@@ -1,5 +1,54 @@
+# Ce script calcule la géométrie d'une couche en WGS84 pour l'utiliser comme filtre spatial des requêtes GBIF
+# (GBIF.py, CDPNQ/GBIF.py) : soit son emprise rectangulaire, soit un contour simplifié qui suit la forme
+# de la zone d'étude (--contour).
+#
+# Le contour est l'union des géométries de la couche, sans trous, élargie puis simplifiée avec la même
+# tolérance : il contient toujours la couche d'origine. La tolérance est augmentée jusqu'à respecter le
+# nombre maximal de sommets, et les anneaux sont orientés dans le sens antihoraire comme l'exige GBIF.
+#
+# L'emprise est lue dans les métadonnées de la source (étendue de la couche ou index spatial, avec
+# pyogrio) dans sa projection d'origine, puis seul le contour densifié de cette emprise est reprojeté en
+# WGS84 : la couche n'est pas lue au complet. --lecture-complete lit et reprojette toutes les géométries.
+#
+# Si l'entrée est un répertoire, chaque couche de chaque fichier vectoriel est traitée en parallèle
+# (--processus) et les géométries sont réunies dans un seul fichier (GeoJSON, ou WKT par ligne).
+#
+# --journal écrit la durée du calcul (et en mode répertoire, un événement par couche avec sa durée dans
+# le processus de travail) dans un journal JSON (instrumentation.py).
+#
+# Exemples :
+#   python bounding_box.py zone_etude.gpkg --contour --tolerance 0.01 --max-sommets 500
+#   python bounding_box.py donnees/ --processus 8 --sortie emprises.geojson
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import geopandas as gpd
-from shapely.geometry import box
+import shapely
+from pyproj import CRS, Transformer
+from shapely.geometry import Polygon, box
+
+import instrumentation
+from instrumentation import count, event, stage
+
+try:
+    import pyogrio
+except ImportError:  # Sans pyogrio, l'emprise est calculée en lisant toute la couche
+    pyogrio = None
+
+# Tolérance de simplification du contour (en degrés) et nombre maximal de sommets par défaut
+default_tolerance = 0.01
+default_max_vertices = 500
+
+# Nombre de points ajoutés sur chaque côté de l'emprise avant sa reprojection
+densify_points = 21
+
+# Extensions des fichiers vectoriels traités en mode répertoire
+vector_extensions = ('.gpkg', '.shp', '.geojson', '.json', '.fgb', '.gml', '.kml', '.sqlite', '.parquet')
+
 
 # Fonction pour obtenir l'emprise en format WKT
 def get_bounding_box_wkt(layer):
@@ -10,23 +59,224 @@ def get_bounding_box_wkt(layer):
     # Retourner la représentation WKT de l'emprise
     return bbox.wkt
 
-# Demander à l'utilisateur de fournir le chemin du fichier
-file_path = input("Veuillez fournir le chemin du fichier: ")
 
-# Charger la couche
-layer = gpd.read_file(file_path)
+# Retirer les trous des polygones : un contour plus large que la couche reste un filtre valide
+def remove_holes(geometry):
+    polygons = shapely.get_parts(geometry)
+    return shapely.union_all([Polygon(polygon.exterior) for polygon in polygons])
+
+
+# Fonction pour obtenir un contour simplifié en format WKT, d'au plus max_vertices sommets.
+# Les points et les lignes n'ont pas de surface : ils sont élargis de la tolérance.
+def get_footprint_wkt(layer, tolerance=default_tolerance, max_vertices=default_max_vertices):
+    geometries = layer.geometry.values
+    geometries = geometries[~shapely.is_empty(geometries) & ~shapely.is_missing(geometries)]
+    polygonal = shapely.get_type_id(geometries) >= 3
+    geometries[~polygonal] = shapely.buffer(geometries[~polygonal], tolerance)
+    footprint = remove_holes(shapely.union_all(geometries).buffer(0))
+    if footprint.is_empty:
+        raise ValueError("La couche ne contient aucune géométrie : impossible de calculer son contour.")
+
+    # Le contour exact est conservé s'il respecte déjà le nombre maximal de sommets
+    if shapely.get_num_coordinates(footprint) <= max_vertices:
+        return shapely.orient_polygons(footprint, exterior_cw=False).wkt
+
+    # Doubler la tolérance tant que le contour a trop de sommets; l'élargissement fusionne aussi les
+    # petites parties voisines. Au-delà d'une tolérance d'un dixième de la zone, l'enveloppe convexe
+    # puis l'emprise sont plus serrées qu'un contour aussi élargi.
+    min_x, min_y, max_x, max_y = footprint.bounds
+    simplified = None
+    while tolerance < max(max_x - min_x, max_y - min_y) / 10:
+        candidate = remove_holes(footprint.buffer(tolerance).simplify(tolerance))
+        if shapely.get_num_coordinates(candidate) <= max_vertices:
+            simplified = candidate
+            break
+        tolerance *= 2
+    if simplified is None:
+        simplified = footprint.convex_hull
+        if shapely.get_num_coordinates(simplified) > max_vertices:
+            simplified = box(*footprint.bounds)
+
+    return shapely.orient_polygons(simplified, exterior_cw=False).wkt
+
+
+# Fonction pour obtenir l'emprise en WKT (WGS84) à partir des métadonnées de la source, sans lire les
+# géométries. Le contour de l'emprise est densifié avant la reprojection pour que l'emprise en WGS84
+# contienne toute la couche malgré la courbure des côtés.
+def get_extent_wkt(file_path, layer_name=None):
+    info = pyogrio.read_info(file_path, layer=layer_name, force_total_bounds=True)
+    if info['total_bounds'] is None:
+        raise ValueError(f"Impossible de lire l'emprise de {file_path}.")
+    if info['crs'] is None:
+        raise ValueError(f"La couche {file_path} n'a pas de système de coordonnées.")
+    crs = CRS.from_user_input(info['crs'])
+    if crs.equals(CRS.from_epsg(4326)):
+        return box(*info['total_bounds']).wkt
+    transformer = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True)
+    return box(*transformer.transform_bounds(*info['total_bounds'], densify_pts=densify_points)).wkt
+
+
+# Lire une couche, la reprojeter en WGS84 et retourner son emprise ou son contour simplifié en WKT.
+# L'emprise est lue dans les métadonnées de la source, sauf si full_read est demandé.
+def get_layer_geometry_wkt(file_path, footprint=False, tolerance=default_tolerance,
+                           max_vertices=default_max_vertices, layer_name=None, full_read=False):
+    if not footprint and not full_read and pyogrio is not None:
+        return get_extent_wkt(file_path, layer_name)
+
+    # Charger la couche
+    layer = gpd.read_file(file_path, layer=layer_name)
+
+    # Reprojeter la couche en WGS84
+    layer = layer.to_crs(epsg=4326)
+
+    if footprint:
+        return get_footprint_wkt(layer, tolerance, max_vertices)
+    return get_bounding_box_wkt(layer)
+
+
+# Lire une géométrie WKT donnée en filtre spatial : depuis un fichier texte, depuis le contour simplifié
+# d'une couche vectorielle, ou telle quelle si ce n'est pas un fichier (un WKT valide est alors exigé)
+def read_geometry(geometry, tolerance=default_tolerance, max_vertices=default_max_vertices):
+    if not os.path.isfile(geometry):
+        try:
+            shapely.from_wkt(geometry)
+        except shapely.errors.GEOSException:
+            raise ValueError(f"'{geometry}' n'est ni un fichier existant ni une géométrie WKT valide.") from None
+        return geometry
+    if os.path.splitext(geometry)[1].lower() in ('.txt', '.wkt'):
+        with open(geometry, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    return get_layer_geometry_wkt(geometry, footprint=True, tolerance=tolerance, max_vertices=max_vertices)
+
+
+# Couches (fichier, nom de couche) des fichiers vectoriels d'un répertoire, sous-répertoires compris.
+# Les répertoires de fichiers (File Geodatabase) sont traités comme un seul fichier.
+def find_layers(directory):
+    layers = []
+    for root, dirs, files in os.walk(directory):
+        sources = [os.path.join(root, name) for name in files if name.lower().endswith(vector_extensions)]
+        sources += [os.path.join(root, name) for name in dirs if name.lower().endswith('.gdb')]
+        dirs[:] = [name for name in dirs if not name.lower().endswith('.gdb')]
+        for source in sorted(sources):
+            if pyogrio is None:
+                layers.append((source, None))
+                continue
+            try:
+                layers.extend((source, layer_name) for layer_name in pyogrio.list_layers(source)[:, 0])
+            except Exception:
+                continue  # Fichier illisible par GDAL (p. ex. un JSON qui n'est pas du GeoJSON)
+    return layers
+
+
+# Calculer la géométrie d'une couche (exécuté dans un processus de travail); retourne la géométrie WKT
+# ou le message d'erreur, et la durée du calcul
+def _layer_geometry(task):
+    file_path, layer_name, footprint, tolerance, max_vertices, full_read = task
+    start = time.perf_counter()
+    try:
+        wkt = get_layer_geometry_wkt(file_path, footprint, tolerance, max_vertices, layer_name, full_read)
+        return wkt, None, time.perf_counter() - start
+    except Exception as e:
+        return None, str(e), time.perf_counter() - start
+
+
+# Traiter toutes les couches d'un répertoire en parallèle et écrire les géométries dans un fichier
+# GeoJSON (.geojson) ou texte (une ligne 'fichier<TAB>couche<TAB>WKT' par couche)
+def process_directory(directory, output_path, footprint=False, tolerance=default_tolerance,
+                      max_vertices=default_max_vertices, workers=None, full_read=False):
+    layers = find_layers(directory)
+    tasks = [(path, layer_name, footprint, tolerance, max_vertices, full_read) for path, layer_name in layers]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = []
+        for (path, layer_name), (wkt, error, seconds) in zip(layers, executor.map(_layer_geometry, tasks, chunksize=4)):
+            event('couche', fichier=path, couche=layer_name, secondes=round(seconds, 6), erreur=error)
+            count('couches')
+            results.append((wkt, error))
+
+    if output_path.lower().endswith(('.geojson', '.json')):
+        features = [
+            {
+                'type': 'Feature',
+                'properties': {'fichier': os.path.relpath(path, directory), 'couche': layer_name, 'erreur': error},
+                'geometry': json.loads(shapely.to_geojson(shapely.from_wkt(wkt))) if wkt else None
+            }
+            for (path, layer_name), (wkt, error) in zip(layers, results)
+        ]
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    else:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            for (path, layer_name), (wkt, error) in zip(layers, results):
+                if wkt:
+                    f.write(f"{os.path.relpath(path, directory)}\t{layer_name or ''}\t{wkt}\n")
+
+    for (path, layer_name), (wkt, error) in zip(layers, results):
+        if error:
+            print(f"Erreur pour {path} ({layer_name}) : {error}")
+    return len(layers), sum(1 for wkt, error in results if error)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Emprise ou contour simplifié d'une couche en WKT (WGS84).")
+    parser.add_argument('entree', nargs='?', help="Chemin du fichier de la couche, ou d'un répertoire de fichiers")
+    parser.add_argument('--couche', help="Nom de la couche à lire (GeoPackage à plusieurs couches)")
+    parser.add_argument('--contour', action='store_true', help="Contour simplifié plutôt que l'emprise rectangulaire")
+    parser.add_argument('--tolerance', type=float, default=default_tolerance, help="Tolérance de simplification (en degrés)")
+    parser.add_argument('--max-sommets', type=int, default=default_max_vertices, help="Nombre maximal de sommets du contour")
+    parser.add_argument(
+        '--lecture-complete', action='store_true',
+        help="Lire et reprojeter toutes les géométries plutôt que l'emprise des métadonnées"
+    )
+    parser.add_argument('--processus', type=int, help="Nombre de processus en mode répertoire (par défaut : tous les cœurs)")
+    parser.add_argument(
+        '--sortie', help="Fichier texte du WKT (par défaut : bounding_box_wkt.txt), ou en mode répertoire, "
+                         "fichier GeoJSON ou texte des géométries (par défaut : emprises.geojson)"
+    )
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    instrumentation.configure_from_args('bounding_box', args)
+    try:
+        process(args)
+    finally:
+        instrumentation.summary()
+        instrumentation.close()
+
+
+# Traiter le fichier ou le répertoire donné en ligne de commande
+def process(args):
+    # Demander à l'utilisateur de fournir le chemin du fichier s'il n'est pas donné
+    file_path = args.entree or input("Veuillez fournir le chemin du fichier: ")
+
+    # Mode répertoire : toutes les couches des fichiers vectoriels
+    if os.path.isdir(file_path) and not file_path.lower().rstrip('/\\').endswith('.gdb'):
+        output_path = args.sortie or 'emprises.geojson'
+        with stage('repertoire', entree=file_path):
+            layer_count, errors = process_directory(
+                file_path, output_path, args.contour, args.tolerance, args.max_sommets, args.processus, args.lecture_complete
+            )
+        print(f"{layer_count - errors} couches sur {layer_count} traitées. Géométries sauvegardées dans {output_path}")
+        return
+
+    with stage('geometrie', entree=file_path, contour=args.contour):
+        geometry_wkt = get_layer_geometry_wkt(
+            file_path, args.contour, args.tolerance, args.max_sommets, args.couche, args.lecture_complete
+        )
 
-# Reprojeter la couche en WGS84
-layer = layer.to_crs(epsg=4326)
+    # Afficher la géométrie en WKT
+    label = "Footprint" if args.contour else "Bounding Box"
+    print(f"{label} in WKT (WGS84): {geometry_wkt}")
 
-# Obtenir l'emprise en format WKT
-bounding_box_wkt = get_bounding_box_wkt(layer)
+    # Sauvegarder la géométrie en WKT dans un fichier texte
+    output_path = args.sortie or 'bounding_box_wkt.txt'
+    with open(output_path, 'w') as f:
+        f.write(geometry_wkt)
 
-# Afficher l'emprise en WKT
-print(f"Bounding Box in WKT (WGS84): {bounding_box_wkt}")
+    print(f"Géométrie en WKT sauvegardée dans {output_path}")
 
-# Sauvegarder l'emprise en WKT dans un fichier texte
-with open('bounding_box_wkt.txt', 'w') as f:
-    f.write(bounding_box_wkt)
 
-print("Emprise en WKT sauvegardée dans bounding_box_wkt.txt")
+if __name__ == "__main__":
+    main()
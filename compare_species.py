@@ -1,5 +1,26 @@
+import argparse
 import csv
+import hashlib
 import json
+import os
+import pickle
+import re
+from collections import Counter
+from itertools import chain
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import instrumentation
+from instrumentation import count, stage
+
+# Taille des blocs lus à la fois dans le fichier CSV (en octets)
+default_block_size = 64 * 1024 * 1024
+
+# Marqueurs de rang et qualificatifs ignorés entre le genre et l'épithète
+rank_markers = {'var.', 'var', 'subsp.', 'subsp', 'ssp.', 'ssp', 'f.', 'forma', 'cf.', 'cf', 'aff.', 'aff', 'x', '×'}
 
 def load_iucn_list(filename):
     iucn_dict = {}
@@ -13,6 +34,166 @@ def load_iucn_list(filename):
 def normalize_species_name(name):
     return name.strip().lower()
 
+# Nom canonique (genre + épithète) d'un nom scientifique : l'auteur, le sous-genre entre parenthèses,
+# les rangs infraspécifiques et les marqueurs d'hybride sont retirés
+def canonical_species_name(name):
+    name = re.sub(r'\([^)]*\)', ' ', normalize_species_name(name)).replace('×', ' ')
+    words = [word.strip(',') for word in name.split()]
+    words = [word for word in words if word and word not in rank_markers]
+    if not words or not re.fullmatch(r'[a-zà-ÿ-]+', words[0]):
+        return ''
+    if len(words) > 1 and re.fullmatch(r'[a-zà-ÿ-]+', words[1]):
+        return f"{words[0]} {words[1]}"
+    return words[0]
+
+# Lire une table de synonymes {synonyme: nom accepté} : format de l'API UICN (result avec les champs
+# synonym et accepted_name) ou objet JSON simple
+def load_synonyms(filename):
+    with open(filename, mode='r', encoding='utf-8') as file:
+        data = json.load(file)
+    if isinstance(data, dict) and 'result' in data:
+        return {entry['synonym']: entry['accepted_name'] for entry in data['result']}
+    return data
+
+# Distance d'édition de Levenshtein en bande, abandonnée dès qu'elle dépasse max_distance : seules les
+# cases à au plus max_distance de la diagonale sont calculées, les autres valent max_distance + 1
+def edit_distance(a, b, max_distance):
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    limit = max_distance + 1
+    previous = [j if j <= max_distance else limit for j in range(len(b) + 1)]
+    for i, char_a in enumerate(a, 1):
+        start = max(1, i - max_distance)
+        end = min(len(b), i + max_distance)
+        current = [limit] * (len(b) + 1)
+        current[0] = i if i <= max_distance else limit
+        row_min = current[0]
+        for j in range(start, end + 1):
+            value = previous[j - 1] + (char_a != b[j - 1])
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            if value > limit:
+                value = limit
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            return limit
+        previous = current
+    return previous[-1]
+
+# Index de n-grammes des noms canoniques : les candidats d'une recherche à distance d'édition bornée sont
+# les noms qui partagent assez de n-grammes avec le nom cherché (chaque modification en retire au plus n),
+# puis seule leur distance est calculée
+class NGramIndex:
+    def __init__(self, words, n=3):
+        self.n = n
+        self.words = list(words)
+        self.postings = {}
+        for word_id, word in enumerate(self.words):
+            for gram in self.grams(word):
+                self.postings.setdefault(gram, []).append(word_id)
+
+    def grams(self, word):
+        return {word[i:i + self.n] for i in range(len(word) - self.n + 1)}
+
+    # Mots à au plus max_distance de word, triés par distance
+    def search(self, word, max_distance):
+        grams = self.grams(word)
+        counts = Counter(chain.from_iterable(self.postings.get(gram, ()) for gram in grams))
+        threshold = max(len(grams) - max_distance * self.n, 1)
+        matches = []
+        for word_id in [word_id for word_id, count in counts.items() if count >= threshold]:
+            candidate = self.words[word_id]
+            if abs(len(candidate) - len(word)) <= max_distance:
+                distance = edit_distance(word, candidate, max_distance)
+                if distance <= max_distance:
+                    matches.append((distance, candidate))
+        return sorted(matches)
+
+# Index de correspondance des noms d'espèces avec la liste UICN : nom exact, nom canonique, synonyme, puis
+# nom canonique le plus proche à distance d'édition bornée (sauf si fuzzy est faux). Les résultats sont
+# mémorisés par nom.
+class SpeciesMatcher:
+    def __init__(self, iucn_list, synonyms=None, max_distance=2, min_fuzzy_length=8, fuzzy=True):
+        self.iucn_list = iucn_list
+        self.fuzzy = fuzzy
+        self.max_distance = max_distance
+        self.min_fuzzy_length = min_fuzzy_length
+
+        # Le nom de l'espèce elle-même a priorité sur ceux de ses sous-espèces
+        self.canonical = {}
+        for species_name, category in iucn_list.items():
+            canonical = canonical_species_name(species_name)
+            if canonical and (canonical == species_name or canonical not in self.canonical):
+                self.canonical[canonical] = category
+
+        self.synonyms = {}
+        for synonym, accepted_name in (synonyms or {}).items():
+            category = self.canonical.get(canonical_species_name(accepted_name))
+            if category is not None:
+                self.synonyms.setdefault(canonical_species_name(synonym), category)
+
+        self.index = NGramIndex(self.canonical if fuzzy else ())
+        self.cache = {}
+
+    def _match(self, species_name):
+        if species_name in self.iucn_list:
+            return self.iucn_list[species_name], 'exact'
+        canonical = canonical_species_name(species_name)
+        if canonical in self.canonical:
+            return self.canonical[canonical], 'canonical'
+        if canonical in self.synonyms:
+            return self.synonyms[canonical], 'synonym'
+        if self.fuzzy and len(canonical) >= self.min_fuzzy_length and ' ' in canonical:
+            matches = self.index.search(canonical, self.max_distance)
+            # Un nom équidistant de deux espèces reste sans correspondance
+            if matches and (len(matches) == 1 or matches[0][0] < matches[1][0]):
+                return self.canonical[matches[0][1]], 'fuzzy'
+        return None, None
+
+    # Retourner (catégorie, méthode) pour un nom normalisé, ou (None, None) s'il n'a pas de correspondance
+    def match(self, species_name):
+        if species_name not in self.cache:
+            self.cache[species_name] = self._match(species_name)
+            count(f"correspondances_{self.cache[species_name][1] or 'aucune'}")
+        return self.cache[species_name]
+
+    # Enregistrer l'index et les correspondances mémorisées. Seules des structures de base sont conservées,
+    # pour que le fichier se charge que le script soit exécuté directement ou importé.
+    def save(self, path, source_hash):
+        state = {**vars(self), 'index': vars(self.index)}
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump((source_hash, state), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def from_state(cls, state):
+        matcher = cls.__new__(cls)
+        matcher.__dict__.update(state)
+        matcher.index = NGramIndex.__new__(NGramIndex)
+        matcher.index.__dict__.update(state['index'])
+        return matcher
+
+# Charger l'index enregistré s'il a été construit avec les mêmes fichiers et paramètres, sinon le construire
+def load_species_matcher(json_file, synonyms_file=None, index_path=None, max_distance=2, fuzzy=True):
+    digest = hashlib.sha256(f"{max_distance} {fuzzy}".encode())
+    for filename in filter(None, (json_file, synonyms_file)):
+        with open(filename, 'rb') as file:
+            digest.update(file.read())
+    source_hash = digest.hexdigest()
+
+    if index_path and os.path.exists(index_path):
+        with open(index_path, 'rb') as file:
+            saved_hash, state = pickle.load(file)
+        if saved_hash == source_hash:
+            return SpeciesMatcher.from_state(state), source_hash
+
+    synonyms = load_synonyms(synonyms_file) if synonyms_file else None
+    return SpeciesMatcher(load_iucn_list(json_file), synonyms, max_distance, fuzzy=fuzzy), source_hash
+
 def compare_species(csv_file, json_file, output_file):
     iucn_list = load_iucn_list(json_file)
     found_species = []
@@ -36,7 +217,121 @@ def compare_species(csv_file, json_file, output_file):
     
     return found_species, not_found_species
 
+# Normaliser une colonne de noms d'espèces en une seule opération (comme normalize_species_name)
+def normalize_species_column(names):
+    return pc.utf8_lower(pc.utf8_trim_whitespace(names))
+
+# Joindre les catégories UICN par blocs : les noms sont normalisés par colonne, les catégories sont
+# associées par table de hachage et chaque bloc est écrit aussitôt en CSV ou en Parquet (selon
+# l'extension du fichier de sortie). Retourne le nombre de lignes par catégorie et les noms uniques
+# non trouvés, plutôt que la liste de toutes les lignes.
+# Avec un SpeciesMatcher, les noms uniques sans correspondance exacte d'un bloc passent par l'index
+# (nom canonique, synonyme, distance d'édition) et la colonne match_type indique la méthode retenue.
+def compare_species_chunked(csv_file, json_file, output_file, block_size=default_block_size, matcher=None):
+    iucn_list = load_iucn_list(json_file)
+    iucn_names = pa.array(list(iucn_list.keys()), type=pa.string())
+    iucn_categories = pa.array(list(iucn_list.values()), type=pa.string())
+    category_counts = {}
+    not_found_species = set()
+
+    with open(csv_file, mode='r', newline='', encoding='utf-8') as infile:
+        fieldnames = next(csv.reader(infile), [])
+    species_column = 'species' if 'species' in fieldnames else 'scientificName' if 'scientificName' in fieldnames else None
+
+    # Le fichier de sortie est créé avant la lecture : un fichier sans lignes produit une sortie avec
+    # seulement l'en-tête, comme le traitement ligne par ligne
+    output_columns = fieldnames + ['category'] + (['match_type'] if matcher is not None else [])
+    schema = pa.schema([(name, pa.string()) for name in output_columns])
+    if output_file.lower().endswith('.parquet'):
+        writer = pq.ParquetWriter(output_file, schema)
+    else:
+        writer = pa_csv.CSVWriter(output_file, schema)
+
+    # Toutes les colonnes sont lues comme du texte pour être réécrites telles quelles
+    reader = pa_csv.open_csv(
+        csv_file,
+        read_options=pa_csv.ReadOptions(block_size=block_size),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in fieldnames}, strings_can_be_null=False
+        )
+    ) if fieldnames else []
+    try:
+        for batch in reader:
+            if species_column is not None:
+                species_names = normalize_species_column(batch.column(species_column))
+            else:
+                species_names = pa.array([''] * batch.num_rows, type=pa.string())
+            categories = pc.take(iucn_categories, pc.index_in(species_names, value_set=iucn_names))
+            not_found = pc.is_null(categories)
+            if matcher is not None:
+                match_types = pc.if_else(not_found, pa.scalar(None, pa.string()), 'exact')
+                unmatched_names = pc.unique(pc.filter(species_names, not_found))
+                matches = [matcher.match(name) for name in unmatched_names.to_pylist()]
+                matched_positions = pc.index_in(species_names, value_set=unmatched_names)
+                categories = pc.coalesce(
+                    categories, pc.take(pa.array([category for category, method in matches], pa.string()), matched_positions)
+                )
+                match_types = pc.coalesce(
+                    match_types, pc.take(pa.array([method for category, method in matches], pa.string()), matched_positions)
+                )
+                not_found = pc.is_null(categories)
+            categories = pc.fill_null(categories, 'Not Found')
+
+            for entry in pc.value_counts(categories).to_pylist():
+                category_counts[entry['values']] = category_counts.get(entry['values'], 0) + entry['counts']
+            not_found_species.update(pc.unique(pc.filter(species_names, not_found)).to_pylist())
+
+            table = pa.Table.from_batches([batch]).append_column('category', categories)
+            if matcher is not None:
+                table = table.append_column('match_type', pc.fill_null(match_types, 'none'))
+            writer.write_table(table.cast(schema))
+            count('lignes', batch.num_rows)
+            count('entites_ecrites', table.num_rows)
+    finally:
+        writer.close()
+
+    return category_counts, sorted(not_found_species)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Associer les catégories UICN aux espèces d'un fichier CSV.")
+    parser.add_argument('csv', nargs='?', default='species.csv', help="Fichier CSV des espèces")
+    parser.add_argument('json', nargs='?', default='CA.json', help="Liste UICN en JSON")
+    parser.add_argument('sortie', nargs='?', default='species_with_category.csv', help="Fichier de sortie (.csv ou .parquet)")
+    parser.add_argument('--taille-bloc', type=int, default=64, help="Taille des blocs lus à la fois (en Mo)")
+    parser.add_argument('--approximatif', action='store_true', help="Associer aussi les noms canoniques, synonymes et noms proches (distance d'édition)")
+    parser.add_argument(
+        '--synonymes',
+        help="Table de synonymes en JSON (format de l'API UICN ou {synonyme: nom accepté}); sans --approximatif, "
+             "seuls les noms canoniques et les synonymes sont associés, sans distance d'édition"
+    )
+    parser.add_argument('--distance-max', type=int, default=2, help="Distance d'édition maximale des noms proches")
+    parser.add_argument('--index', default='iucn_index.pkl', help="Fichier de l'index de correspondance enregistré")
+    parser.add_argument('--par-ligne', action='store_true', help="Traiter le fichier ligne par ligne (ancien mode)")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    found, not_found = compare_species('species.csv', 'CA.json', 'species_with_category.csv')
-    print(f"Espèces trouvées: {found}")
-    print(f"Espèces non trouvées: {not_found}")
+    args = parse_args()
+    instrumentation.configure_from_args('compare_species', args)
+    if args.par_ligne:
+        with stage('jointure', mode='par_ligne'):
+            found, not_found = compare_species(args.csv, args.json, args.sortie)
+        print(f"Espèces trouvées: {found}")
+        print(f"Espèces non trouvées: {not_found}")
+    else:
+        matcher = None
+        if args.approximatif or args.synonymes:
+            with stage('index_correspondance'):
+                matcher, source_hash = load_species_matcher(
+                    args.json, args.synonymes, args.index, args.distance_max, args.approximatif
+                )
+        with stage('jointure', mode='blocs'):
+            counts, not_found = compare_species_chunked(
+                args.csv, args.json, args.sortie, args.taille_bloc * 1024 * 1024, matcher
+            )
+        if matcher is not None:
+            matcher.save(args.index, source_hash)
+        print(f"Lignes par catégorie: {counts}")
+        print(f"Espèces non trouvées ({len(not_found)} noms uniques): {not_found}")
+    instrumentation.summary()
+    instrumentation.close()
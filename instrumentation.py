@@ -0,0 +1,170 @@
+# Instrumentation partagée des outils : minuteries par étape, compteurs et journal JSON (une ligne par
+# événement), avec profilage cProfile et mesure de la mémoire (tracemalloc) optionnels pour chaque étape.
+#
+# Les outils appellent les fonctions du module (stage, count, event) sur une instance globale. Sans
+# configuration, les compteurs et les durées sont cumulés en mémoire sans rien écrire. configure() ou
+# les variables d'environnement OUTILS_JOURNAL, OUTILS_PROFIL et OUTILS_MEMOIRE (utiles dans la console
+# QGIS) activent le journal, le profilage et la mesure de la mémoire.
+#
+# Compteurs communs : requetes, reprises, succes_cache, octets_telecharges, evaluations_distance,
+# entites_ecrites.
+#
+# Exemple :
+#   with stage('recolte'):
+#       count('requetes')
+#   summary()
+#
+# Le profilage ne couvre que le fil d'exécution qui ouvre l'étape, et une seule étape à la fois (les
+# étapes imbriquées dans une étape profilée ne le sont pas). Le pic de mémoire d'une étape imbriquée est
+# celui mesuré depuis le début de l'étape qui l'englobe.
+
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class Instrumentation:
+    def __init__(self, tool=None, log_path=None, profile_dir=None, trace_memory=False):
+        self.tool = tool
+        self.log_path = log_path
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.counters = {}
+        self.stage_seconds = {}
+        self.lock = threading.Lock()
+        self.log_file = open(log_path, 'a', encoding='utf-8') if log_path else None
+        self.profiling = False
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    # Incrémenter un compteur (sûr entre fils d'exécution)
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Écrire un événement dans le journal JSON
+    def event(self, name, **fields):
+        if self.log_file is None:
+            return
+        record = {'temps': datetime.now().isoformat(timespec='milliseconds'), 'outil': self.tool, 'evenement': name, **fields}
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self.lock:
+            self.log_file.write(line + '\n')
+            self.log_file.flush()
+
+    # Mesurer une étape : durée, compteurs incrémentés pendant l'étape et, si demandé, profil et pic de mémoire
+    @contextmanager
+    def stage(self, name, **fields):
+        with self.lock:
+            counters_before = dict(self.counters)
+        profiler = None
+        if self.profile_dir and not self.profiling:
+            profiler = cProfile.Profile()
+            self.profiling = True
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        self.event('debut_etape', etape=name, **fields)
+        start = time.perf_counter()
+        status = 'termine'
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        except BaseException:
+            status = 'erreur'
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profiling = False
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0) + seconds
+                counters = {
+                    counter: value - counters_before.get(counter, 0)
+                    for counter, value in self.counters.items() if value != counters_before.get(counter, 0)
+                }
+            details = {'secondes': round(seconds, 6), 'compteurs': counters, 'statut': status}
+            if self.trace_memory:
+                details['pic_memoire_mo'] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 3)
+                if started_tracing:
+                    tracemalloc.stop()
+            if profiler is not None:
+                profile_path = os.path.join(self.profile_dir, f"{self.tool or 'outil'}_{name}_{os.getpid()}.prof")
+                profiler.dump_stats(profile_path)
+                details['profil'] = profile_path
+            self.event('fin_etape', etape=name, **fields, **details)
+
+    # Écrire le bilan des compteurs et des durées cumulées par étape, puis le retourner
+    def summary(self):
+        with self.lock:
+            totals = {
+                'compteurs': dict(self.counters),
+                'secondes_par_etape': {name: round(seconds, 6) for name, seconds in self.stage_seconds.items()}
+            }
+        self.event('bilan', **totals)
+        return totals
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+
+# Instance globale utilisée par tous les outils, configurée au besoin par les variables d'environnement
+instrumentation = Instrumentation(
+    log_path=os.environ.get('OUTILS_JOURNAL'),
+    profile_dir=os.environ.get('OUTILS_PROFIL'),
+    trace_memory=bool(os.environ.get('OUTILS_MEMOIRE'))
+)
+
+
+# Remplacer l'instance globale; les options absentes reprennent les variables d'environnement
+def configure(tool=None, log_path=None, profile_dir=None, trace_memory=False):
+    global instrumentation
+    instrumentation.close()
+    instrumentation = Instrumentation(
+        tool,
+        log_path or os.environ.get('OUTILS_JOURNAL'),
+        profile_dir or os.environ.get('OUTILS_PROFIL'),
+        trace_memory or bool(os.environ.get('OUTILS_MEMOIRE'))
+    )
+    return instrumentation
+
+
+# Options de ligne de commande communes aux outils
+def add_arguments(parser):
+    parser.add_argument('--journal', help="Fichier du journal JSON (une ligne par événement)")
+    parser.add_argument('--profil', help="Répertoire des profils cProfile de chaque étape")
+    parser.add_argument('--memoire', action='store_true', help="Mesurer le pic de mémoire Python de chaque étape")
+
+
+def configure_from_args(tool, args):
+    return configure(tool, args.journal, args.profil, args.memoire)
+
+
+def count(name, value=1):
+    instrumentation.count(name, value)
+
+
+def event(name, **fields):
+    instrumentation.event(name, **fields)
+
+
+def stage(name, **fields):
+    return instrumentation.stage(name, **fields)
+
+
+def summary():
+    return instrumentation.summary()
+
+
+def close():
+    instrumentation.close()
@@ -0,0 +1,194 @@
+# Serveur local imitant l'API de téléchargement GBIF, pour tester GBIF.py sans réseau.
+#
+# Points d'accès simulés :
+# - POST /occurrence/download/request : retourne une clé de téléchargement
+# - GET /occurrence/download/{clé} : état PREPARING, puis RUNNING, puis SUCCEEDED après quelques vérifications
+# - GET /occurrence/download/request/{clé}.zip : archive Darwin Core générée, avec prise en charge des
+#   requêtes HTTP Range (réponses 206)
+# - GET /species/match : correspondance exacte pour tout nom, sauf ceux qui commencent par 'Inconnu'
+# - GET /occurrence/search : pages d'occurrences générées (--occurrences-par-taxon par clé de taxon)
+#
+# Exemple :
+#   python mock_gbif_server.py --port 8080 --occurrences 100000
+#   python GBIF.py --api-url http://127.0.0.1:8080
+
+import argparse
+import io
+import json
+import random
+import re
+import threading
+import zipfile
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Colonnes du fichier occurrence.txt généré
+occurrence_columns = [
+    'gbifID', 'speciesKey', 'species', 'decimalLatitude', 'decimalLongitude',
+    'countryCode', 'iucnRedListCategory', 'year'
+]
+
+
+# Générer une archive Darwin Core contenant des occurrences aléatoires au Québec
+def build_archive(occurrences, seed=0):
+    rng = random.Random(seed)
+    lines = ['\t'.join(occurrence_columns)]
+    for gbif_id in range(1, occurrences + 1):
+        species_key = rng.randint(1, 200)
+        lines.append('\t'.join([
+            str(gbif_id),
+            str(species_key),
+            f"Genus{species_key} species{species_key}",
+            f"{rng.uniform(45.0, 62.0):.5f}",
+            f"{rng.uniform(-79.5, -57.0):.5f}",
+            'CA',
+            rng.choice(['NT', 'VU', 'EN', 'CR']),
+            str(rng.randint(1950, 2025))
+        ]))
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('occurrence.txt', '\n'.join(lines) + '\n')
+        archive.writestr('meta.xml', '<archive xmlns="http://rs.tdwg.org/dwc/text/"/>')
+    return buffer.getvalue()
+
+
+class MockGBIFHandler(BaseHTTPRequestHandler):
+    def _send(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/occurrence/download/request':
+            return self._send(404)
+        length = int(self.headers.get('Content-Length', 0))
+        json.loads(self.rfile.read(length) or b'{}')
+        with self.server.lock:
+            self.server.download_count += 1
+            key = f"{self.server.download_count:07d}-mock"
+            self.server.downloads[key] = 0
+        self._send(201, key.encode(), 'text/plain')
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(parts.query).items()}
+        if parts.path == '/species/match':
+            return self._send_match(query)
+        if parts.path == '/occurrence/search':
+            return self._send_search(query)
+        match = re.fullmatch(r'/occurrence/download/request/([\w-]+)\.zip', self.path)
+        if match:
+            return self._send_archive(match.group(1))
+        match = re.fullmatch(r'/occurrence/download/([\w-]+)', self.path)
+        if match:
+            return self._send_status(match.group(1))
+        self._send(404)
+
+    # Clé de taxon stable dérivée du nom
+    def _send_match(self, query):
+        name = query.get('name', '')
+        if name.startswith('Inconnu'):
+            return self._send(200, json.dumps({'matchType': 'NONE'}).encode())
+        meta = {'usageKey': zlib.crc32(name.encode('utf-8')) % 10000000, 'matchType': 'EXACT', 'scientificName': name}
+        self._send(200, json.dumps(meta).encode())
+
+    # Page de résultats d'un taxon : coordonnées déterministes selon la clé de taxon et la position
+    def _send_search(self, query):
+        taxon_key = int(query.get('taxonKey', 0))
+        limit = min(int(query.get('limit', 20)), 300)
+        offset = int(query.get('offset', 0))
+        count = self.server.occurrences_per_taxon
+        rng = random.Random(taxon_key * 1000003 + offset)
+        results = [
+            {
+                'key': taxon_key * count + index,
+                'taxonKey': taxon_key,
+                'decimalLatitude': round(rng.uniform(45.0, 62.0), 5),
+                'decimalLongitude': round(rng.uniform(-79.5, -57.0), 5)
+            }
+            for index in range(offset, min(offset + limit, count))
+        ]
+        page = {'offset': offset, 'limit': limit, 'endOfRecords': offset + limit >= count, 'count': count, 'results': results}
+        self._send(200, json.dumps(page).encode())
+
+    # Avancer l'état d'un téléchargement à chaque vérification
+    def _send_status(self, key):
+        with self.server.lock:
+            if key not in self.server.downloads:
+                return self._send(404)
+            self.server.downloads[key] += 1
+            polls = self.server.downloads[key]
+        if polls <= self.server.polls_before_success // 2:
+            status = 'PREPARING'
+        elif polls <= self.server.polls_before_success:
+            status = 'RUNNING'
+        else:
+            status = 'SUCCEEDED'
+        host, port = self.server.server_address[:2]
+        meta = {
+            'key': key,
+            'status': status,
+            'size': len(self.server.archive),
+            'totalRecords': self.server.occurrences,
+            'downloadLink': f"http://{host}:{port}/occurrence/download/request/{key}.zip"
+        }
+        self._send(200, json.dumps(meta).encode())
+
+    # Servir l'archive complète ou la plage d'octets demandée
+    def _send_archive(self, key):
+        archive = self.server.archive
+        range_header = self.headers.get('Range')
+        if not range_header:
+            return self._send(200, archive, 'application/zip', {'Accept-Ranges': 'bytes'})
+        start = int(re.fullmatch(r'bytes=(\d+)-', range_header).group(1))
+        if start >= len(archive):
+            return self._send(416, headers={'Content-Range': f"bytes */{len(archive)}"})
+        self._send(206, archive[start:], 'application/zip', {
+            'Accept-Ranges': 'bytes',
+            'Content-Range': f"bytes {start}-{len(archive) - 1}/{len(archive)}"
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Démarrer le serveur dans un fil d'exécution et retourner (serveur, URL de base)
+def start_mock_server(port=0, occurrences=1000, polls_before_success=2, seed=0, occurrences_per_taxon=500):
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockGBIFHandler)
+    server.lock = threading.Lock()
+    server.downloads = {}
+    server.download_count = 0
+    server.occurrences = occurrences
+    server.polls_before_success = polls_before_success
+    server.occurrences_per_taxon = occurrences_per_taxon
+    server.archive = build_archive(occurrences, seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serveur local imitant l'API de téléchargement GBIF.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--occurrences', type=int, default=1000, help="Nombre d'occurrences de l'archive générée")
+    parser.add_argument('--verifications', type=int, default=2, help="Nombre de vérifications avant SUCCEEDED")
+    parser.add_argument('--occurrences-par-taxon', type=int, default=500, help="Nombre d'occurrences par taxon de la recherche")
+    args = parser.parse_args()
+
+    server, url = start_mock_server(
+        args.port, args.occurrences, args.verifications, occurrences_per_taxon=args.occurrences_par_taxon
+    )
+    print(f"Serveur GBIF simulé sur {url} (Ctrl-C pour arrêter)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -17,9 +17,22 @@ Fonctionnalités principales :
 - Filtrage des entités en fonction d'une expression.
 - Calcul des tenants en fonction de la distance entre les blocs.
 - Calculs de superficie en hectares.
-- Création d'une nouvelle couche avec symbologie catégorisée par tenant.
+- Création d'une nouvelle couche avec symbologie catégorisée par tenant, en mémoire ou écrite
+  directement dans un fichier GeoPackage ou FlatGeobuf.
+- Recalcul incrémental avec un fichier d'état : seuls les tenants touchés par des blocs ajoutés,
+  modifiés ou supprimés depuis l'exécution précédente sont recalculés (requiert Shapely).
+
+Le regroupement des blocs en tenants et les calculs de superficie sont faits par tenants_engine.py,
+qui peut aussi être exécuté en ligne de commande sans QGIS.
+
+La durée de chaque étape et les compteurs (évaluations de distance, entités écrites) sont cumulés par
+instrumentation.py; définir OUTILS_JOURNAL (et au besoin OUTILS_PROFIL, OUTILS_MEMOIRE) dans
+l'environnement de QGIS les écrit dans un journal JSON.
 """
 
+import os
+import sys
+
 from qgis.core import *
 from PyQt5.QtCore import QVariant, Qt
 from PyQt5.QtWidgets import (
@@ -27,6 +40,103 @@ from PyQt5.QtWidgets import (
     QPushButton, QMessageBox, QLineEdit, QSpinBox
 )
 
+# Rendre le moteur de calcul des tenants importable depuis la console Python de QGIS
+script_dir = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+if script_dir not in sys.path:
+    sys.path.insert(0, script_dir)
+
+from instrumentation import configure, count, stage, summary
+import tenants_engine
+from tenants_engine import assign_tenants, load_state
+
+# Construire un index spatial sur les emprises des entités
+def build_spatial_index(features):
+    spatial_index = QgsSpatialIndex()
+    features_by_id = {}
+    for feature in features:
+        spatial_index.addFeature(feature)
+        features_by_id[feature.id()] = feature
+    return spatial_index, features_by_id
+
+# Retourner chaque paire de blocs (id, id) séparés d'au plus la distance, une seule fois.
+# Seuls les blocs dont l'emprise chevauche l'emprise agrandie de la distance sont comparés.
+def find_neighbour_pairs(features, distance):
+    spatial_index, features_by_id = build_spatial_index(features)
+    pairs = []
+    evaluations = 0
+    for feature in features:
+        geom = feature.geometry()
+        search_rect = geom.boundingBox().buffered(distance)
+        for candidate_id in spatial_index.intersects(search_rect):
+            if candidate_id <= feature.id():
+                continue
+            evaluations += 1
+            if geom.distance(features_by_id[candidate_id].geometry()) <= distance:
+                pairs.append((feature.id(), candidate_id))
+    count('evaluations_distance', evaluations)
+    count('paires_voisines', len(pairs))
+    return pairs
+
+# Nombre d'entités écrites à la fois dans la couche des tenants
+BATCH_SIZE = 5000
+
+# Créer l'entité de sortie de chaque bloc, au fur et à mesure de l'écriture
+def build_tenant_features(features, records, fields, additional_fields):
+    for feature in features:
+        record = records[feature.id()]
+        attributes = [
+            record.tenant,
+            record.blocs_partages,
+            feature.id(),
+            record.superficie_bloc,
+            record.superficie_tenant,
+            record.pourcentage_superficie
+        ]
+
+        # Ajouter les valeurs des champs supplémentaires
+        for field_name in additional_fields:
+            value = feature[field_name]
+            attributes.append(value if value is not None else NULL)
+
+        new_feature = QgsFeature(fields)
+        new_feature.setGeometry(feature.geometry())
+        new_feature.setAttributes(attributes)
+        yield new_feature
+
+# Ajouter un lot d'entités. Le fournisseur de données retourne (succès, entités) et
+# QgsVectorFileWriter retourne seulement le succès.
+def add_batch(sink, batch):
+    result = sink.addFeatures(batch)
+    return result[0] if isinstance(result, tuple) else result
+
+# Écrire les entités par lots avec addFeatures (fournisseur de données ou fichier)
+def write_features_in_batches(sink, features, batch_size=BATCH_SIZE):
+    batch = []
+    for feature in features:
+        batch.append(feature)
+        if len(batch) >= batch_size:
+            if not add_batch(sink, batch):
+                return False
+            count('entites_ecrites', len(batch))
+            batch = []
+    if batch and not add_batch(sink, batch):
+        return False
+    count('entites_ecrites', len(batch))
+    return True
+
+# Créer un fichier GeoPackage ou FlatGeobuf (selon l'extension) pour y écrire la couche des tenants
+def create_file_writer(output_path, fields, wkb_type, crs):
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'FlatGeobuf' if output_path.lower().endswith('.fgb') else 'GPKG'
+    options.layerName = 'Tenants'
+    # Dans un GeoPackage existant, remplacer seulement la couche 'Tenants' sans effacer les autres couches
+    if options.driverName == 'GPKG' and os.path.exists(output_path):
+        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
+    writer = QgsVectorFileWriter.create(output_path, fields, wkb_type, crs, QgsProject.instance().transformContext(), options)
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise IOError(writer.errorMessage())
+    return writer
+
 class TenantProcessorDialog(QDialog):
     def __init__(self, layers):
         super().__init__()
@@ -71,6 +181,20 @@ class TenantProcessorDialog(QDialog):
         self.distance_spinbox.setValue(60)  # Valeur par défaut
         self.layout().addWidget(self.distance_spinbox)
 
+        # Fichier de sortie (optionnel)
+        self.output_label = QLabel("Entrez le fichier de sortie (laisser vide pour une couche en mémoire):")
+        self.layout().addWidget(self.output_label)
+        self.output_input = QLineEdit()
+        self.output_input.setPlaceholderText("Ex: C:/donnees/tenants.gpkg ou tenants.fgb")
+        self.layout().addWidget(self.output_input)
+
+        # Fichier d'état pour le recalcul incrémental (optionnel)
+        self.state_label = QLabel("Entrez le fichier d'état (recalculer seulement les tenants touchés, optionnel):")
+        self.layout().addWidget(self.state_label)
+        self.state_input = QLineEdit()
+        self.state_input.setPlaceholderText("Ex: C:/donnees/tenants_etat.pkl")
+        self.layout().addWidget(self.state_input)
+
         # Bouton pour exécuter le traitement
         self.process_button = QPushButton("Attribuer les Tenants")
         self.process_button.clicked.connect(self.process)
@@ -102,24 +226,32 @@ class TenantProcessorDialog(QDialog):
         return selected_fields
 
     def process(self):
+        configure('tenants')
         selected_layer_name = self.layer_combo.currentText()
         selected_layer = next(layer for layer in self.layers if layer.name() == selected_layer_name)
         nom_bloc_field = self.field_combo.currentText()
         additional_fields = self.get_selected_fields()
         expression = self.expression_input.text()
         distance = self.distance_spinbox.value()
+        output_path = self.output_input.text().strip()
+        state_path = self.state_input.text().strip()
+
+        if state_path and tenants_engine.shapely is None:
+            QMessageBox.warning(self, "Avertissement", "Shapely est requis pour le recalcul incrémental avec un fichier d'état.")
+            return
 
         if not nom_bloc_field:
             QMessageBox.warning(self, "Avertissement", "Veuillez sélectionner un champ pour le nom du bloc.")
             return
 
         # Filtrer les entités en fonction de l'expression
-        if expression:
-            expr = QgsExpression(expression)
-            request = QgsFeatureRequest(expr)
-            filtered_features = [f for f in selected_layer.getFeatures(request)]
-        else:
-            filtered_features = selected_layer.getFeatures()
+        with stage('lecture', couche=selected_layer_name):
+            if expression:
+                expr = QgsExpression(expression)
+                request = QgsFeatureRequest(expr)
+                filtered_features = [f for f in selected_layer.getFeatures(request)]
+            else:
+                filtered_features = [f for f in selected_layer.getFeatures()]
 
         if not filtered_features:
             QMessageBox.warning(self, "Avertissement", "Aucune entité ne correspond à l'expression de filtrage.")
@@ -128,116 +260,90 @@ class TenantProcessorDialog(QDialog):
         # Obtenir le CRS du projet
         project_crs = QgsProject.instance().crs()
 
-        # Créer une nouvelle couche en mémoire avec le CRS du projet
-        mem_layer = QgsVectorLayer("Polygon", "Tenants", "memory")
-        mem_layer.setCrs(project_crs)
-
-        # Ajouter les champs à la nouvelle couche
-        fields_to_add = [
-            QgsField('tenant', QVariant.Int),
-            QgsField('blocs_partages', QVariant.String),
-            QgsField('id_original', QVariant.Int),
-            QgsField('superficie_bloc', QVariant.Double),
-            QgsField('superficie_tenant', QVariant.Double),
-            QgsField('pourcentage_superficie', QVariant.Double)
-        ]
+        # Définir les champs de la nouvelle couche
+        fields = QgsFields()
+        fields.append(QgsField('tenant', QVariant.Int))
+        fields.append(QgsField('blocs_partages', QVariant.String))
+        fields.append(QgsField('id_original', QVariant.Int))
+        fields.append(QgsField('superficie_bloc', QVariant.Double))
+        fields.append(QgsField('superficie_tenant', QVariant.Double))
+        fields.append(QgsField('pourcentage_superficie', QVariant.Double))
         for field_name in additional_fields:
             field = selected_layer.fields().field(field_name)
-            fields_to_add.append(QgsField(field.name(), field.type()))
-
-        mem_layer.dataProvider().addAttributes(fields_to_add)
-        mem_layer.updateFields()
-
-        # Initialiser un dictionnaire pour les tenants
-        tenant_dict = {}
-        tenant_id = 1
-        tenant_blocs = {}
-        tenant_areas = {}
-
-        # Parcourir les entités filtrées et attribuer des tenants
+            fields.append(QgsField(field.name(), field.type()))
+
+        if output_path:
+            # Écrire directement dans un fichier GeoPackage ou FlatGeobuf, sans copie en mémoire
+            try:
+                sink = create_file_writer(output_path, fields, selected_layer.wkbType(), project_crs)
+            except IOError as e:
+                QMessageBox.warning(self, "Avertissement", f"Impossible de créer le fichier de sortie: {e}")
+                return
+        else:
+            # Créer une nouvelle couche en mémoire avec le CRS du projet
+            mem_layer = QgsVectorLayer("Polygon", "Tenants", "memory")
+            mem_layer.setCrs(project_crs)
+            mem_layer.dataProvider().addAttributes(fields.toList())
+            mem_layer.updateFields()
+            sink = mem_layer.dataProvider()
+
+        # Conserver les blocs dont la géométrie est valide
+        valid_features = []
         for feature in filtered_features:
             geom = feature.geometry()
             if not geom or geom.isNull() or not geom.isGeosValid():
                 print(f"Géométrie invalide pour l'entité ID: {feature.id()}")
                 continue
-
-            assigned = False
-            nom_bloc = feature[nom_bloc_field]  # Utiliser le champ sélectionné
-            bloc_area = geom.area() / 10000  # Convertir en hectares
-
-            # Vérifier la distance minimale avec les autres blocs
-            for other_feature in filtered_features:
-                if other_feature.id() != feature.id():
-                    other_geom = other_feature.geometry()
-                    distance_between = geom.distance(other_geom)
-
-                    if distance_between <= distance:
-                        if other_feature.id() in tenant_dict:
-                            tenant = tenant_dict[other_feature.id()]
-                        else:
-                            tenant = tenant_id
-                            tenant_id += 1
-
-                        tenant_dict[feature.id()] = tenant
-                        tenant_dict[other_feature.id()] = tenant
-
-                        # Ajouter les noms des blocs partagés
-                        if tenant not in tenant_blocs:
-                            tenant_blocs[tenant] = []
-                        tenant_blocs[tenant].append(nom_bloc)
-                        tenant_blocs[tenant].append(other_feature[nom_bloc_field])
-
-                        # Ajouter la superficie du bloc au total du tenant
-                        if tenant not in tenant_areas:
-                            tenant_areas[tenant] = 0
-                        tenant_areas[tenant] += bloc_area
-
-                        assigned = True
-                        break
-
-            if not assigned:
-                tenant_dict[feature.id()] = tenant_id
-                tenant_id += 1
-                tenant_blocs[tenant_dict[feature.id()]] = [nom_bloc]
-                tenant_areas[tenant_dict[feature.id()]] = bloc_area
+            valid_features.append(feature)
+
+        block_ids = [feature.id() for feature in valid_features]
+        if state_path:
+            # Recalculer seulement les tenants touchés depuis l'exécution précédente
+            with stage('mise_a_jour', blocs=len(valid_features)):
+                state = load_state(state_path, distance)
+                geometries = tenants_engine.shapely.from_wkb([bytes(feature.geometry().asWkb()) for feature in valid_features])
+                updated_tenants = state.update(block_ids, list(geometries), [feature[nom_bloc_field] for feature in valid_features])
+                records = state.records(block_ids)
+            print(f"{len(updated_tenants)} tenants recalculés.")
+        else:
+            # Regrouper en tenants tous les blocs reliés par une chaîne de voisins
+            with stage('voisins', blocs=len(valid_features)):
+                pairs = find_neighbour_pairs(valid_features, distance)
+            with stage('regroupement'):
+                bloc_areas = {feature.id(): feature.geometry().area() / 10000 for feature in valid_features}  # Convertir en hectares
+                bloc_names = {feature.id(): feature[nom_bloc_field] for feature in valid_features}  # Utiliser le champ sélectionné
+                records = assign_tenants(block_ids, pairs, bloc_names, bloc_areas)
 
         # Ajouter les entités avec les champs 'tenant', 'blocs_partages', 'id_original', et les calculs de superficie à la nouvelle couche
-        mem_layer.startEditing()
-        for feature in filtered_features:
-            tenant = tenant_dict[feature.id()]
-            blocs_partages = ', '.join(set(tenant_blocs[tenant]))  # Utiliser set pour éviter les doublons
-            bloc_area = feature.geometry().area() / 10000  # Convertir en hectares
-            tenant_area = tenant_areas[tenant]
-            pourcentage_superficie = (bloc_area / tenant_area) * 100 if tenant_area > 0 else 0
-
-            attributes = [
-                tenant,
-                blocs_partages,
-                feature.id(),
-                bloc_area,
-                tenant_area,
-                pourcentage_superficie
-            ]
-
-            # Ajouter les valeurs des champs supplémentaires
-            for field_name in additional_fields:
-                value = feature[field_name]
-                attributes.append(value if value is not None else NULL)
-
-            new_feature = QgsFeature()
-            new_feature.setGeometry(feature.geometry())
-            new_feature.setAttributes(attributes)
-            mem_layer.addFeature(new_feature)
-        mem_layer.commitChanges()
+        new_features = build_tenant_features(valid_features, records, fields, additional_fields)
+        with stage('ecriture'):
+            written = write_features_in_batches(sink, new_features)
+        summary()
+        if not written:
+            QMessageBox.warning(self, "Avertissement", "Erreur lors de l'écriture des entités de la couche 'Tenants'.")
+            return
+        if state_path:
+            state.save(state_path)
+
+        if output_path:
+            # Fermer le fichier pour terminer l'écriture, puis le charger comme couche
+            del sink
+            if output_path.lower().endswith('.fgb'):
+                tenant_layer = QgsVectorLayer(output_path, "Tenants", "ogr")
+            else:
+                tenant_layer = QgsVectorLayer(f"{output_path}|layername=Tenants", "Tenants", "ogr")
+        else:
+            tenant_layer = mem_layer
+            tenant_layer.updateExtents()
 
         # Appliquer une symbologie catégorisée par tenant
         renderer = QgsCategorizedSymbolRenderer('tenant')
         renderer.setClassAttribute('tenant')
-        mem_layer.setRenderer(renderer)
-        mem_layer.triggerRepaint()
+        tenant_layer.setRenderer(renderer)
+        tenant_layer.triggerRepaint()
 
         # Ajouter la nouvelle couche au projet QGIS
-        QgsProject.instance().addMapLayer(mem_layer)
+        QgsProject.instance().addMapLayer(tenant_layer)
 
         QMessageBox.information(self, "Succès", "Les tenants ont été attribués avec succès et la nouvelle couche 'Tenants' a été ajoutée au projet.")
         self.close()
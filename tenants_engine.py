@@ -0,0 +1,499 @@
+"""
+tenants_engine.py
+
+Auteur : Simon Bédard
+
+Moteur de calcul des tenants, utilisable sans QGIS.
+
+Ce module regroupe le calcul des tenants partagé par le dialogue QGIS (tenants.py) et par une
+utilisation en ligne de commande sur des serveurs de traitement. Les blocs de récolte séparés
+d'au plus une distance donnée sont regroupés en tenants, puis la superficie de chaque bloc, la
+superficie totale de son tenant et son pourcentage de la superficie du tenant sont calculés.
+
+Fonctionnalités principales :
+- Regroupement des blocs en tenants par ensembles disjoints (union-find).
+- Recherche des paires de blocs voisins avec un index spatial STRtree (GeoPandas/Shapely).
+- Recherche parallèle des paires de voisins par tuiles sur plusieurs processus.
+- Recalcul incrémental des seuls tenants touchés par des blocs ajoutés, modifiés ou supprimés.
+- Lecture d'une couche GeoPackage ou shapefile et écriture par lots de la couche des tenants
+  (GeoPackage, FlatGeobuf ou shapefile).
+
+La durée de chaque étape (lecture, voisins, regroupement, écriture) et les compteurs (paires de
+voisins, entités écrites) sont cumulés par instrumentation.py et écrits dans un journal JSON avec
+--journal; --profil et --memoire ajoutent le profil cProfile et le pic de mémoire de chaque étape.
+
+Exemple :
+    python tenants_engine.py blocs.gpkg tenants.gpkg --champ-nom NOM_BLOC --distance 60 \\
+        --filtre "ANNEE == 2025" --champs ANNEE TYPE_COUPE --processus 8 --etat tenants_etat.pkl
+"""
+
+import argparse
+import math
+import os
+import pickle
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+from instrumentation import count, stage
+
+try:
+    import geopandas as gpd
+    import numpy as np
+    import shapely
+    from shapely import STRtree
+except ImportError:  # Le dialogue QGIS n'utilise que le regroupement en pur Python
+    gpd = None
+    np = None
+    shapely = None
+    STRtree = None
+
+try:
+    import pyogrio
+except ImportError:  # Sans pyogrio, le nombre d'entités écrites n'est pas vérifié
+    pyogrio = None
+
+# Champs calculés de la couche des tenants, dans l'ordre de la couche produite
+TENANT_FIELDS = [
+    'tenant',
+    'blocs_partages',
+    'id_original',
+    'superficie_bloc',
+    'superficie_tenant',
+    'pourcentage_superficie'
+]
+
+# Attributs calculés d'un bloc
+TenantRecord = namedtuple(
+    'TenantRecord',
+    ['tenant', 'blocs_partages', 'superficie_bloc', 'superficie_tenant', 'pourcentage_superficie']
+)
+
+# Structure d'ensembles disjoints (union-find) avec compression de chemin et union par rang
+class UnionFind:
+    def __init__(self, items=()):
+        self.parent = {}
+        self.rank = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if item not in self.parent:
+            self.parent[item] = item
+            self.rank[item] = 0
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Compression de chemin
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a == root_b:
+            return root_a
+        # Union par rang
+        if self.rank[root_a] < self.rank[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        if self.rank[root_a] == self.rank[root_b]:
+            self.rank[root_a] += 1
+        return root_a
+
+# Attribuer un numéro de tenant à chaque bloc à partir des paires de voisins.
+# Les tenants sont numérotés selon le plus petit identifiant de bloc qu'ils contiennent,
+# le résultat ne dépend donc pas de l'ordre des entités.
+def cluster_tenants(block_ids, pairs):
+    union_find = UnionFind(block_ids)
+    for a, b in pairs:
+        union_find.union(a, b)
+
+    tenant_by_root = {}
+    tenant_dict = {}
+    for block_id in sorted(block_ids):
+        root = union_find.find(block_id)
+        if root not in tenant_by_root:
+            tenant_by_root[root] = len(tenant_by_root) + 1
+        tenant_dict[block_id] = tenant_by_root[root]
+    return tenant_dict
+
+# Calculer la liste des blocs partagés et la superficie totale de chaque tenant
+def summarize_tenants(tenant_dict, bloc_names, bloc_areas):
+    tenant_names = {}
+    tenant_areas = {}
+    for block_id, tenant in tenant_dict.items():
+        tenant_names.setdefault(tenant, set()).add(str(bloc_names[block_id]))
+        tenant_areas[tenant] = tenant_areas.get(tenant, 0) + bloc_areas[block_id]
+    tenant_blocs = {tenant: ', '.join(sorted(names)) for tenant, names in tenant_names.items()}
+    return tenant_blocs, tenant_areas
+
+# Calculer les attributs de tenant de chaque bloc à partir des paires de voisins.
+# Les superficies sont en hectares.
+def assign_tenants(block_ids, pairs, bloc_names, bloc_areas):
+    tenant_dict = cluster_tenants(block_ids, pairs)
+    tenant_blocs, tenant_areas = summarize_tenants(tenant_dict, bloc_names, bloc_areas)
+
+    records = {}
+    for block_id in block_ids:
+        tenant = tenant_dict[block_id]
+        bloc_area = bloc_areas[block_id]
+        tenant_area = tenant_areas[tenant]
+        pourcentage_superficie = (bloc_area / tenant_area) * 100 if tenant_area > 0 else 0
+        records[block_id] = TenantRecord(tenant, tenant_blocs[tenant], bloc_area, tenant_area, pourcentage_superficie)
+    return records
+
+# Retourner chaque paire d'indices (i, j), i < j, de géométries séparées d'au plus la distance.
+# L'index STRtree élimine les paires dont les emprises sont trop éloignées avant le calcul exact.
+def find_neighbour_pairs(geometries, distance):
+    tree = STRtree(geometries)
+    left, right = tree.query(geometries, predicate='dwithin', distance=distance)
+    keep = left < right
+    return list(zip(left[keep].tolist(), right[keep].tolist()))
+
+# Trouver les paires de voisins des blocs d'une tuile (exécuté dans un processus de travail).
+# Les géométries arrivent en WKB; les 'core_count' premières appartiennent à la tuile et les
+# suivantes sont les blocs voisins situés dans la bordure de la tuile.
+def _find_tile_pairs(wkb_geometries, global_ids, core_count, distance):
+    geometries = shapely.from_wkb(wkb_geometries)
+    tree = STRtree(geometries)
+    left, right = tree.query(geometries[:core_count], predicate='dwithin', distance=distance)
+    left = global_ids[left]
+    right = global_ids[right]
+    # Une paire (i, j) n'est conservée que depuis la tuile du plus petit indice i,
+    # chaque paire est donc produite une seule fois
+    keep = left < right
+    return list(zip(left[keep].tolist(), right[keep].tolist()))
+
+# Découper l'étendue des blocs en tuiles et retourner, pour chaque tuile, les indices des blocs
+# qui lui appartiennent suivis des indices des blocs de sa bordure.
+# Un bloc appartient à la tuile qui contient le coin inférieur gauche de son emprise; la bordure
+# contient les blocs dont l'emprise est à moins de la distance des emprises des blocs de la tuile.
+def split_into_tiles(geometries, distance, tile_count):
+    bounds = shapely.bounds(geometries)
+    xmin, ymin = bounds[:, 0].min(), bounds[:, 1].min()
+    xmax, ymax = bounds[:, 2].max(), bounds[:, 3].max()
+    tiles_per_axis = max(1, math.ceil(math.sqrt(tile_count)))
+    tile_width = max((xmax - xmin) / tiles_per_axis, distance, 1e-9)
+    tile_height = max((ymax - ymin) / tiles_per_axis, distance, 1e-9)
+
+    columns = np.minimum(((bounds[:, 0] - xmin) // tile_width).astype(int), tiles_per_axis - 1)
+    rows = np.minimum(((bounds[:, 1] - ymin) // tile_height).astype(int), tiles_per_axis - 1)
+    owners = rows * tiles_per_axis + columns
+
+    envelope_tree = STRtree(shapely.envelope(geometries))
+    tiles = []
+    for owner in np.unique(owners):
+        core = np.flatnonzero(owners == owner)
+        core_bounds = bounds[core]
+        search_box = shapely.box(
+            core_bounds[:, 0].min() - distance,
+            core_bounds[:, 1].min() - distance,
+            core_bounds[:, 2].max() + distance,
+            core_bounds[:, 3].max() + distance
+        )
+        border = np.setdiff1d(envelope_tree.query(search_box), core)
+        tiles.append((core, border))
+    return tiles
+
+# Trouver les paires de voisins en répartissant les tuiles sur plusieurs processus.
+# Le résultat est identique à celui de find_neighbour_pairs.
+def find_neighbour_pairs_parallel(geometries, distance, workers):
+    if len(geometries) == 0:
+        return []
+
+    geometries = np.asarray(geometries)
+    wkb_geometries = shapely.to_wkb(geometries)
+    pairs = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for core, border in split_into_tiles(geometries, distance, workers * 4):
+            tile_ids = np.concatenate([core, border])
+            futures.append(executor.submit(_find_tile_pairs, wkb_geometries[tile_ids], tile_ids, len(core), distance))
+        for future in futures:
+            pairs.extend(future.result())
+    pairs.sort()
+    return pairs
+
+# État des tenants conservé entre deux exécutions pour le recalcul incrémental.
+# Lors d'une mise à jour, seuls les tenants touchés par des blocs ajoutés, déplacés, renommés ou
+# supprimés sont recalculés; les autres tenants conservent leur numéro et leur superficie.
+class TenantState:
+    def __init__(self, distance):
+        self.distance = distance
+        self.geometries = {}  # bloc -> géométrie
+        self.names = {}  # bloc -> nom
+        self.areas = {}  # bloc -> superficie (ha)
+        self.neighbours = {}  # bloc -> blocs à moins de la distance
+        self.tenant_dict = {}  # bloc -> tenant
+        self.tenant_members = {}  # tenant -> blocs
+        self.tenant_blocs = {}  # tenant -> noms des blocs partagés
+        self.tenant_areas = {}  # tenant -> superficie (ha)
+        self.next_tenant = 1
+
+    # Charger un état enregistré avec save
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Mettre à jour l'état avec l'ensemble actuel des blocs et retourner les tenants recalculés
+    def update(self, block_ids, geometries, names, workers=1):
+        new_geometries = dict(zip(block_ids, geometries))
+        new_names = dict(zip(block_ids, names))
+
+        removed = [block_id for block_id in self.geometries if block_id not in new_geometries]
+        added = [block_id for block_id in block_ids if block_id not in self.geometries]
+        kept = [block_id for block_id in block_ids if block_id in self.geometries]
+        unchanged = shapely.equals_exact(
+            np.array([self.geometries[block_id] for block_id in kept], dtype=object),
+            np.array([new_geometries[block_id] for block_id in kept], dtype=object),
+            tolerance=0
+        )
+        moved = [block_id for block_id, same in zip(kept, unchanged) if not same]
+        renamed = [block_id for block_id in kept if self.names[block_id] != new_names[block_id]]
+
+        # Les tenants des blocs modifiés ou supprimés doivent être recalculés
+        affected_tenants = {self.tenant_dict[block_id] for block_id in removed + moved + renamed}
+
+        # Retirer les liens de voisinage des blocs déplacés ou supprimés
+        for block_id in removed + moved:
+            for other_id in self.neighbours.pop(block_id, ()):
+                if other_id in self.neighbours:
+                    self.neighbours[other_id].discard(block_id)
+        for block_id in removed:
+            tenant = self.tenant_dict.pop(block_id)
+            self.tenant_members[tenant].discard(block_id)
+            del self.geometries[block_id], self.names[block_id], self.areas[block_id]
+
+        changed = moved + added
+        for block_id in changed:
+            self.geometries[block_id] = new_geometries[block_id]
+            self.areas[block_id] = new_geometries[block_id].area / 10000  # Convertir en hectares
+            self.neighbours[block_id] = set()
+        for block_id in renamed + added:
+            self.names[block_id] = new_names[block_id]
+
+        # Rechercher les voisins des blocs ajoutés ou déplacés seulement
+        for a, b in self._find_changed_pairs(changed, workers):
+            self.neighbours[a].add(b)
+            self.neighbours[b].add(a)
+        for block_id in changed:
+            affected_tenants.update(
+                self.tenant_dict[other_id] for other_id in self.neighbours[block_id] if other_id in self.tenant_dict
+            )
+
+        # Regrouper les blocs des tenants touchés en nouveaux tenants
+        affected_blocks = set(added)
+        for tenant in affected_tenants:
+            affected_blocks.update(self.tenant_members[tenant])
+        union_find = UnionFind(affected_blocks)
+        for block_id in affected_blocks:
+            for other_id in self.neighbours[block_id]:
+                union_find.union(block_id, other_id)
+        components = {}
+        for block_id in sorted(affected_blocks):
+            components.setdefault(union_find.find(block_id), []).append(block_id)
+
+        # Un nouveau tenant reprend le plus petit numéro libéré parmi ceux de ses blocs
+        free_tenants = set(affected_tenants)
+        for tenant in affected_tenants:
+            del self.tenant_members[tenant], self.tenant_blocs[tenant], self.tenant_areas[tenant]
+        updated_tenants = set()
+        for members in components.values():
+            previous = sorted(
+                {self.tenant_dict[block_id] for block_id in members if block_id in self.tenant_dict} & free_tenants
+            )
+            if previous:
+                tenant = previous[0]
+                free_tenants.discard(tenant)
+            else:
+                tenant = self.next_tenant
+                self.next_tenant += 1
+            for block_id in members:
+                self.tenant_dict[block_id] = tenant
+            self.tenant_members[tenant] = set(members)
+            self.tenant_blocs[tenant] = ', '.join(sorted({str(self.names[block_id]) for block_id in members}))
+            self.tenant_areas[tenant] = sum(self.areas[block_id] for block_id in members)
+            updated_tenants.add(tenant)
+        return updated_tenants | affected_tenants
+
+    # Trouver les paires de voisins dont au moins un bloc a été ajouté ou déplacé
+    def _find_changed_pairs(self, changed, workers):
+        if not changed:
+            return []
+        block_ids = list(self.geometries)
+        geometries = np.array([self.geometries[block_id] for block_id in block_ids], dtype=object)
+
+        # Premier calcul : tous les blocs sont nouveaux
+        if len(changed) == len(block_ids):
+            if workers > 1:
+                index_pairs = find_neighbour_pairs_parallel(geometries, self.distance, workers)
+            else:
+                index_pairs = find_neighbour_pairs(geometries, self.distance)
+            return [(block_ids[i], block_ids[j]) for i, j in index_pairs]
+
+        tree = STRtree(geometries)
+        changed_geometries = np.array([self.geometries[block_id] for block_id in changed], dtype=object)
+        left, right = tree.query(changed_geometries, predicate='dwithin', distance=self.distance)
+        return [
+            (changed[i], block_ids[j]) for i, j in zip(left.tolist(), right.tolist())
+            if changed[i] != block_ids[j]
+        ]
+
+    # Attributs calculés des blocs demandés
+    def records(self, block_ids):
+        records = {}
+        for block_id in block_ids:
+            tenant = self.tenant_dict[block_id]
+            bloc_area = self.areas[block_id]
+            tenant_area = self.tenant_areas[tenant]
+            pourcentage_superficie = (bloc_area / tenant_area) * 100 if tenant_area > 0 else 0
+            records[block_id] = TenantRecord(
+                tenant, self.tenant_blocs[tenant], bloc_area, tenant_area, pourcentage_superficie
+            )
+        return records
+
+# Reprendre l'état enregistré d'un calcul précédent s'il a été fait avec la même distance, sinon
+# retourner un nouvel état
+def load_state(state_path, distance):
+    state = TenantState.load(state_path) if os.path.exists(state_path) else None
+    if state is None or state.distance != distance:
+        state = TenantState(distance)
+    return state
+
+# Calculer la couche des tenants d'un GeoDataFrame de blocs.
+# L'index du GeoDataFrame sert d'identifiant de bloc ('id_original') et le filtre utilise la
+# syntaxe de pandas.DataFrame.query.
+# Avec plus d'un processus, la recherche des voisins est faite en parallèle par tuiles. Si un état
+# (TenantState) est fourni, seuls les tenants touchés depuis le calcul précédent sont recalculés.
+def compute_tenants(blocks, name_field, distance, additional_fields=(), expression=None, workers=1, state=None):
+    if expression:
+        blocks = blocks.query(expression)
+
+    # Conserver les blocs dont la géométrie est valide
+    valid = blocks.geometry.notna() & ~blocks.geometry.is_empty & blocks.geometry.is_valid
+    for block_id in blocks.index[~valid]:
+        print(f"Géométrie invalide pour l'entité ID: {block_id}")
+    blocks = blocks[valid]
+
+    block_ids = blocks.index.tolist()
+    geometries = blocks.geometry.values
+    if state is not None:
+        with stage('mise_a_jour', blocs=len(block_ids)):
+            updated_tenants = state.update(block_ids, list(geometries), blocks[name_field].tolist(), workers)
+            records = state.records(block_ids)
+        print(f"{len(updated_tenants)} tenants recalculés.")
+    else:
+        with stage('voisins', blocs=len(block_ids), processus=workers):
+            if workers > 1:
+                index_pairs = find_neighbour_pairs_parallel(geometries, distance, workers)
+            else:
+                index_pairs = find_neighbour_pairs(geometries, distance)
+            count('paires_voisines', len(index_pairs))
+        with stage('regroupement'):
+            pairs = [(block_ids[i], block_ids[j]) for i, j in index_pairs]
+            bloc_areas = dict(zip(block_ids, (geometries.area / 10000).tolist()))  # Convertir en hectares
+            bloc_names = dict(zip(block_ids, blocks[name_field].tolist()))
+            records = assign_tenants(block_ids, pairs, bloc_names, bloc_areas)
+
+    columns = {
+        'tenant': [records[block_id].tenant for block_id in block_ids],
+        'blocs_partages': [records[block_id].blocs_partages for block_id in block_ids],
+        'id_original': block_ids,
+        'superficie_bloc': [records[block_id].superficie_bloc for block_id in block_ids],
+        'superficie_tenant': [records[block_id].superficie_tenant for block_id in block_ids],
+        'pourcentage_superficie': [records[block_id].pourcentage_superficie for block_id in block_ids]
+    }
+    for field_name in additional_fields:
+        columns[field_name] = blocks[field_name].tolist()
+
+    return gpd.GeoDataFrame(columns, geometry=list(geometries), crs=blocks.crs)
+
+# Écrire la couche des tenants par lots pour limiter la mémoire utilisée lors de la conversion.
+# Le format est déduit de l'extension (.gpkg, .fgb, .shp). FlatGeobuf ne permet pas l'ajout à une
+# couche existante : GDAL écrit alors toutes les entités en un seul passage.
+def write_tenants(tenants, output_path, output_layer='Tenants', batch_size=50000):
+    if output_path.lower().endswith('.fgb'):
+        tenants.to_file(output_path, driver='FlatGeobuf')
+        count('entites_ecrites', len(tenants))
+    else:
+        # Un shapefile ne contient qu'une couche, nommée comme le fichier : un autre nom de couche
+        # ferait écrire les lots suivants dans un second fichier
+        if output_path.lower().endswith('.shp'):
+            output_layer = os.path.splitext(os.path.basename(output_path))[0]
+        for start in range(0, max(len(tenants), 1), batch_size):
+            mode = 'w' if start == 0 else 'a'
+            batch = tenants.iloc[start:start + batch_size]
+            batch.to_file(output_path, layer=output_layer, mode=mode)
+            count('entites_ecrites', len(batch))
+
+    # Vérifier que toutes les entités ont été écrites dans la couche
+    if pyogrio is not None:
+        layer = None if output_path.lower().endswith('.fgb') else output_layer
+        written = pyogrio.read_info(output_path, layer=layer)['features']
+        if written != len(tenants):
+            raise IOError(f"{written} entités écrites dans {output_path} au lieu de {len(tenants)}.")
+
+# Lire une couche de blocs, calculer les tenants et écrire la couche des tenants
+def run(input_path, output_path, name_field, distance, additional_fields=(), expression=None,
+        input_layer=None, output_layer='Tenants', workers=1, state_path=None):
+    if gpd is None:
+        raise ImportError("GeoPandas et Shapely sont requis pour le calcul des tenants hors QGIS.")
+
+    with stage('lecture', entree=input_path):
+        blocks = gpd.read_file(input_path, layer=input_layer, fid_as_index=True)
+    if name_field not in blocks.columns:
+        raise ValueError(f"Le champ '{name_field}' n'existe pas dans la couche.")
+
+    # Reprendre l'état du calcul précédent s'il a été fait avec la même distance
+    state = load_state(state_path, distance) if state_path else None
+
+    tenants = compute_tenants(blocks, name_field, distance, additional_fields, expression, workers, state)
+    if tenants.empty:
+        raise ValueError("Aucune entité ne correspond à l'expression de filtrage.")
+
+    with stage('ecriture', sortie=output_path):
+        write_tenants(tenants, output_path, output_layer)
+    if state_path:
+        state.save(state_path)
+    return tenants
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Attribuer des tenants à des blocs de récolte.")
+    parser.add_argument('entree', help="Couche des blocs de récolte (GeoPackage ou shapefile)")
+    parser.add_argument('sortie', help="Fichier de la couche des tenants à créer")
+    parser.add_argument('--champ-nom', required=True, help="Champ contenant le nom du bloc")
+    parser.add_argument('--distance', type=float, default=60, help="Distance pour le calcul des tenants (en mètres)")
+    parser.add_argument('--champs', nargs='*', default=[], help="Champs supplémentaires à conserver")
+    parser.add_argument('--filtre', help="Expression pour filtrer les entités (syntaxe pandas.DataFrame.query)")
+    parser.add_argument('--couche', help="Nom de la couche à lire dans le fichier d'entrée")
+    parser.add_argument('--couche-sortie', default='Tenants', help="Nom de la couche à écrire")
+    parser.add_argument('--processus', type=int, default=1, help="Nombre de processus pour la recherche des voisins")
+    parser.add_argument('--etat', help="Fichier d'état pour recalculer seulement les tenants touchés par les modifications")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    instrumentation.configure_from_args('tenants_engine', args)
+    try:
+        tenants = run(
+            args.entree, args.sortie, args.champ_nom, args.distance, args.champs, args.filtre,
+            input_layer=args.couche, output_layer=args.couche_sortie, workers=args.processus,
+            state_path=args.etat
+        )
+    finally:
+        instrumentation.summary()
+        instrumentation.close()
+    print(f"{tenants['tenant'].nunique()} tenants attribués à {len(tenants)} blocs. Couche enregistrée dans '{args.sortie}'.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Vérifier que la recherche des voisins par STRtree, en série et en parallèle par tuiles, trouve
+# exactement les paires d'une comparaison de toutes les paires de blocs, et que le recalcul incrémental
+# donne les mêmes tenants qu'un calcul complet.
+
+import itertools
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import tenants_engine
+
+distance = 60
+
+
+# Blocs quadrilatères aléatoires, assez serrés pour avoir des voisins dans plusieurs tuiles
+def random_blocks(count, seed):
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(count) * 400
+    centers = rng.uniform(0, side, (count, 2))
+    radii = rng.uniform(50, 250, (count, 1))
+    angles = rng.uniform(0, 2 * np.pi, (count, 1)) + np.arange(4) * np.pi / 2
+    xs = centers[:, [0]] + radii * np.cos(angles)
+    ys = centers[:, [1]] + radii * np.sin(angles)
+    coordinates = np.stack([xs, ys], axis=-1)
+    return shapely.polygons(np.concatenate([coordinates, coordinates[:, :1]], axis=1))
+
+
+def brute_force_pairs(geometries, distance):
+    return [
+        (i, j) for i, j in itertools.combinations(range(len(geometries)), 2)
+        if shapely.distance(geometries[i], geometries[j]) <= distance
+    ]
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_serial_pairs_match_brute_force(seed):
+    geometries = random_blocks(60, seed)
+    assert sorted(tenants_engine.find_neighbour_pairs(geometries, distance)) == brute_force_pairs(geometries, distance)
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_parallel_pairs_match_brute_force(seed):
+    geometries = random_blocks(60, seed)
+    assert tenants_engine.find_neighbour_pairs_parallel(geometries, distance, 2) == brute_force_pairs(geometries, distance)
+
+
+# Blocs de chaque tenant et attributs calculés de chaque bloc; les numéros de tenant peuvent différer
+# entre un calcul incrémental et un calcul complet
+def tenant_groups(tenants):
+    members = tenants.groupby('tenant')['id_original'].apply(frozenset)
+    return {
+        row.id_original: (
+            members[row.tenant], row.blocs_partages, round(row.superficie_bloc, 6),
+            round(row.superficie_tenant, 6), round(row.pourcentage_superficie, 6)
+        )
+        for row in tenants.itertuples()
+    }
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_incremental_update_matches_full_computation(seed):
+    rng = np.random.default_rng(seed)
+    geometries = random_blocks(80, seed)
+    blocks = gpd.GeoDataFrame({'NOM_BLOC': [f"BLOC-{index}" for index in range(80)]}, geometry=geometries)
+    state = tenants_engine.TenantState(distance)
+    tenants_engine.compute_tenants(blocks, 'NOM_BLOC', distance, state=state)
+
+    # Supprimer, déplacer, renommer et ajouter des blocs
+    blocks = blocks.drop(index=rng.choice(80, 8, replace=False))
+    moved = rng.choice(blocks.index, 8, replace=False)
+    blocks.loc[moved, 'geometry'] = blocks.loc[moved].geometry.translate(*rng.uniform(-300, 300, 2))
+    renamed = rng.choice(blocks.index, 3, replace=False)
+    blocks.loc[renamed, 'NOM_BLOC'] = [f"RENOMME-{index}" for index in renamed]
+    added = gpd.GeoDataFrame(
+        {'NOM_BLOC': [f"NOUVEAU-{index}" for index in range(10)]},
+        geometry=random_blocks(10, seed + 100), index=range(100, 110)
+    )
+    blocks = pd.concat([blocks, added])
+
+    incremental = tenants_engine.compute_tenants(blocks, 'NOM_BLOC', distance, state=state)
+    full = tenants_engine.compute_tenants(blocks, 'NOM_BLOC', distance)
+    assert tenant_groups(incremental) == tenant_groups(full)